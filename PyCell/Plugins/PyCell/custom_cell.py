@@ -17,11 +17,29 @@ Provides prototype cell from which all other cells should derive.
        >>> run(debug=True, step=1)
 
    You can increase the step size to run multiple cells.
+
+Every call to a cell's ``process`` is recorded by :data:`profiler`. To find
+the slowest cells in a circuit, type the following in your console::
+
+    >>> from PyCell.custom_cell import profiler
+    >>> profiler.report()
+    >>> profiler.export('profile.csv')
 """
 from Quantum import QuReturnCode, QuCellSocket
 from traceback_formatter import pprint_tb
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 import sys
 import copy
+import csv
+import functools
+import json
+import threading
+import time
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 
 def exception_raiser(func):
@@ -38,6 +56,280 @@ def exception_raiser(func):
     return exec_func
 
 
+def _rss():
+    """
+    *Internal*. Returns the resident memory of this process in bytes, or
+    ``None`` if ``psutil`` is not installed.
+    """
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+class Profiler(object):
+    """
+    Records the execution of cell processes. Each call to ``process`` adds a
+    record with these fields:
+
+    - ``cell`` and ``py_id``: the cell's class name and id.
+    - ``start`` and ``stop``: wall clock timestamps.
+    - ``seconds``: the duration of the call.
+    - ``rss_start``, ``rss_stop`` and ``rss_delta``: resident memory in bytes.
+      ``None`` unless ``psutil`` is installed.
+    - ``phases``: seconds spent in each :meth:`phase`.
+    - ``counters``: totals passed to :meth:`add`, such as ``bytes_in`` and
+      ``bytes_out`` of the data store.
+    - ``code`` and ``error``: the return code, or the exception raised.
+
+    This class is thread-safe. Cells running in separate threads are recorded
+    separately.
+
+    :param maxlen: The number of records kept. Older records are dropped.
+    :type maxlen: int
+    """
+    def __init__(self, maxlen=10000):
+        self.enabled = True
+        """Set to False to stop recording."""
+        self._records = deque(maxlen=maxlen)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        """
+        The record of the process running in this thread, or ``None``.
+        """
+        return getattr(self._local, 'record', None)
+
+    def profile(self, process):
+        """
+        Decorates a ``process`` method so each call is recorded. A call made
+        through ``super()`` by a cell that is already being recorded is part
+        of the same record.
+        """
+        @functools.wraps(process)
+        def profiled(cell, *args, **kwargs):
+            if not self.enabled or getattr(self._local, 'cell', None) is cell:
+                return process(cell, *args, **kwargs)
+            outer = (self.current, getattr(self._local, 'cell', None))
+            record = self._record(cell)
+            self._local.record, self._local.cell = record, cell
+            begin = time.perf_counter()
+            try:
+                record['code'] = process(cell, *args, **kwargs)
+                return record['code']
+            except Exception as e:
+                record['error'] = repr(e)
+                raise
+            finally:
+                record['seconds'] = time.perf_counter() - begin
+                record['stop'] = time.time()
+                record['rss_stop'] = _rss()
+                if record['rss_start'] is not None:
+                    record['rss_delta'] = (record['rss_stop'] -
+                                           record['rss_start'])
+                self._local.record, self._local.cell = outer
+                with self._lock:
+                    self._records.append(record)
+        return profiled
+
+    def _record(self, cell=None):
+        return OrderedDict([
+            ('cell', type(cell).__name__ if cell is not None else None),
+            ('py_id', getattr(cell, 'py_id', None)),
+            ('thread', threading.current_thread().name),
+            ('start', time.time()), ('stop', None), ('seconds', None),
+            ('rss_start', _rss()), ('rss_stop', None), ('rss_delta', None),
+            ('phases', OrderedDict()),
+            ('counters', OrderedDict([('bytes_in', 0), ('bytes_out', 0)])),
+            ('code', None), ('error', None)])
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Adds the time spent in a ``with`` block to the current record under
+        ``name``. Does nothing outside of a recorded process.
+        """
+        record = self.current
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            if record is not None:
+                phases = record['phases']
+                phases[name] = (phases.get(name, 0) + time.perf_counter() -
+                                begin)
+
+    def add(self, counter, value):
+        """
+        Adds ``value`` to a counter of the current record. Does nothing
+        outside of a recorded process.
+        """
+        record = self.current
+        if record is not None:
+            counters = record['counters']
+            counters[counter] = counters.get(counter, 0) + value
+
+    @contextmanager
+    def capture(self):
+        """
+        Records phases and counters in a process that is not a cell, such as a
+        worker. Yields a dict of ``phases`` and ``counters`` that can be sent
+        back and passed to :meth:`merge`.
+        """
+        outer = self.current
+        record = self._record()
+        self._local.record = record
+        try:
+            yield record
+        finally:
+            self._local.record = outer
+            for k in list(record):
+                if k not in ('phases', 'counters'):
+                    del record[k]
+
+    @contextmanager
+    def attach(self, record):
+        """
+        Makes ``record`` the current record in this thread, so that work
+        handed to another thread is added to the record of the process that
+        started it.
+        """
+        outer = self.current
+        self._local.record = record
+        try:
+            yield record
+        finally:
+            self._local.record = outer
+
+    def merge(self, stats):
+        """
+        Adds the phases and counters from :meth:`capture` to the current
+        record.
+        """
+        record = self.current
+        if record is None or not stats:
+            return
+        for key in ('phases', 'counters'):
+            for k, v in stats.get(key, {}).items():
+                record[key][k] = record[key].get(k, 0) + v
+
+    def records(self, cell=None, py_id=None):
+        """
+        Returns the records, oldest first, optionally only those of a cell
+        class name or ``py_id``.
+        """
+        with self._lock:
+            records = list(self._records)
+        return [r for r in records
+                if (cell is None or r['cell'] == cell) and
+                (py_id is None or r['py_id'] == py_id)]
+
+    def summary(self):
+        """
+        Returns the total and maximum time, the largest memory growth and the
+        data store traffic of each cell, slowest first.
+        """
+        cells = OrderedDict()
+        for r in self.records():
+            s = cells.setdefault((r['cell'], r['py_id']), OrderedDict([
+                ('cell', r['cell']), ('py_id', r['py_id']), ('calls', 0),
+                ('seconds', 0.0), ('max_seconds', 0.0), ('rss_delta', None),
+                ('bytes_in', 0), ('bytes_out', 0)]))
+            s['calls'] += 1
+            s['seconds'] += r['seconds'] or 0
+            s['max_seconds'] = max(s['max_seconds'], r['seconds'] or 0)
+            if r['rss_delta'] is not None:
+                s['rss_delta'] = max(s['rss_delta'] or 0, r['rss_delta'])
+            s['bytes_in'] += r['counters'].get('bytes_in', 0)
+            s['bytes_out'] += r['counters'].get('bytes_out', 0)
+        return sorted(cells.values(), key=lambda s: -s['seconds'])
+
+    def report(self):
+        """
+        Prints :meth:`summary` as a table.
+        """
+        print('{:<20} {:>6} {:>6} {:>10} {:>10} {:>12} {:>12}'.format(
+              'cell', 'id', 'calls', 'seconds', 'max', 'in MB', 'out MB'))
+        for s in self.summary():
+            print('{cell:<20} {py_id:>6} {calls:>6} {seconds:>10.3f} '
+                  '{max_seconds:>10.3f} {:>12.1f} {:>12.1f}'.format(
+                      s['bytes_in'] / 2**20, s['bytes_out'] / 2**20, **s))
+
+    def export(self, path):
+        """
+        Writes the records to ``path``. A ``.csv`` file gets one row per
+        record with a column per phase and counter. Any other file is written
+        as JSON.
+        """
+        records = self.records()
+        if not path.endswith('.csv'):
+            with open(path, 'w') as f:
+                json.dump(records, f, indent=2)
+            return
+        phases = sorted({k for r in records for k in r['phases']})
+        counters = sorted({k for r in records for k in r['counters']})
+        fields = [k for k in self._record() if k not in ('phases', 'counters')]
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(fields + ['phase_' + k for k in phases] + counters)
+            for r in records:
+                writer.writerow([r[k] for k in fields] +
+                                [r['phases'].get(k, 0) for k in phases] +
+                                [r['counters'].get(k, 0) for k in counters])
+
+    def clear(self):
+        """
+        Removes every record.
+        """
+        with self._lock:
+            self._records.clear()
+
+
+profiler = Profiler()
+"""The profiler that records every cell."""
+
+
+_stop_hooks = []
+
+
+def on_stop(func):
+    """
+    Registers ``func`` to be called with the cell each time a cell stops.
+    Plugins use this to release resources when a circuit stops. Can be used
+    as a decorator.
+    """
+    _stop_hooks.append(func)
+    return func
+
+
+def _run_stop_hooks(cell):
+    for hook in _stop_hooks:
+        try:
+            hook(cell)
+        except Exception:
+            pprint_tb(*sys.exc_info())
+
+
+def _stops(stop):
+    """
+    *Internal*. Wraps a ``stop`` method so the stop hooks run after it. A
+    call made through ``super()`` by a cell that is already stopping is part
+    of the same stop, so the hooks run once.
+    """
+    @functools.wraps(stop)
+    def stopped(self, *args, **kwargs):
+        if self.__dict__.get('stopping_'):
+            return stop(self, *args, **kwargs)
+        self.stopping_ = True
+        try:
+            return stop(self, *args, **kwargs)
+        finally:
+            del self.stopping_
+            _run_stop_hooks(self)
+    return stopped
+
+
 class Custom(object):
     """
     This is the abstract type that all PyCells should derive from. It provides
@@ -70,6 +362,13 @@ class Custom(object):
                              on a subsequent call even if none of the inputs
                              have changed. Default, False.
     :type always_reprocess: boolean
+    :param timeout: Seconds that work sent to another process by this cell
+                    may run before it is stopped. ``None`` uses the worker
+                    pool's default, which is also ``None`` unless it is set:
+                    the task then runs until it finishes or is cancelled
+                    with :func:`~PyCell.dataframe_cell.cancel`, and a hung
+                    worker blocks the circuit until then.
+    :type timeout: float or None
     """
     inputs = {}
     outputs = {}
@@ -79,6 +378,14 @@ class Custom(object):
     internal_use = []
     always_reprocess = False
     threadsafe = False
+    timeout = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'process' in cls.__dict__:
+            cls.process = profiler.profile(cls.__dict__['process'])
+        if 'stop' in cls.__dict__:
+            cls.stop = _stops(cls.__dict__['stop'])
 
     def __init__(self):
         self.py_id = 0  # value generated in c++
@@ -93,6 +400,7 @@ class Custom(object):
     def start(self):
         pass
 
+    @_stops
     def stop(self):
         pass
 
@@ -105,14 +413,54 @@ class Custom(object):
         you.
 
         :param code: You can pass a return code here which will get passed on
-                     to the scheduler.
+                     to the scheduler. A failure reported with :meth:`fail`
+                     takes precedence.
         :type code: :class:`~Quantum.QuReturnCode`
         """
+        failure = self.__dict__.pop('failure_', None)
+        if failure is not None:
+            code, self.return_msg_ = failure
         try:
             return code.returncode
         except AttributeError:
             return QuReturnCode('OK').returncode
 
+    def fail(self, msg, code='UNKNOWN'):
+        """
+        Reports a failure to the scheduler. The next call to :meth:`process`
+        returns ``code`` and shows ``msg`` as the cell's message.
+
+        :param msg: Describes the failure.
+        :type msg: string
+        :param code: The name of a :class:`~Quantum.QuReturnCode`.
+        :type code: string
+        """
+        self.failure_ = (QuReturnCode(code), msg)
+
+    def phase(self, name):
+        """
+        Times a ``with`` block as a phase of this cell's profile record. See
+        :meth:`Profiler.phase`.
+        """
+        return profiler.phase(name)
+
+    def is_valid_input(self, value, allow_none=False):
+        """
+        Checks that an optional input has been given a value. Empty strings
+        and unselected options (dicts of choices) are not valid.
+
+        :param value: The input value or socket to check.
+        :param allow_none: Whether ``None`` counts as a value.
+        :type allow_none: boolean
+        """
+        if isinstance(value, QuCellSocket):
+            value = value.value
+        if value is None:
+            return allow_none
+        if isinstance(value, str):
+            return value != ''
+        return not isinstance(value, dict)
+
 
     def return_msg(self):
         try:
@@ -8,11 +8,25 @@ import Quantum
 from Quantum import QuReturnCode, QuCellSocket
 import os
 import sys
+import importlib
+import threading
+import traceback
+import hashlib
+import uuid
+import weakref
+import time
+import signal
+import pickle
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from PyCell import registry
-from PyCell.custom_cell import Custom, ValidInputs, exception_raiser
+from PyCell.custom_cell import Custom, ValidInputs, exception_raiser, profiler
+from PyCell.custom_cell import on_stop
+from PyCell.worker_pool import pool, WorkerError, Cancelled, describe
 # import matplotlib.pyplot as plt
-from kivy.clock import mainthread
 from multiprocessing import Process, Pipe
 
 registry += [
@@ -151,6 +165,944 @@ registry += [
 plugin_cache = os.path.join(os.environ['HOME'], '.kivy', '__cache__')
 os.makedirs(plugin_cache, exist_ok=True)
 
+storage_policies = {
+    'fast': {'format': 'fixed'},
+    'intermediate': {'format': 'table', 'complevel': 1, 'complib': 'blosc'},
+    'final': {'format': 'table', 'complevel': 9, 'complib': 'blosc'},
+    'uncompressed': {'format': 'table'},
+    }
+"""
+Named options used when a frame is written to the H5 cache. ``format`` is
+passed to ``HDFStore.put`` and the remaining options to ``HDFStore``.
+
+.. warning:: Nodes written in ``fixed`` format cannot be queried with
+             ``where`` clauses or :meth:`H5.select_column`.
+"""
+
+default_storage = 'intermediate'
+"""
+The policy used by cells that do not set their own ``storage`` attribute.
+Change it to set the policy for a whole circuit.
+"""
+
+lazy = False
+"""
+If True, ``Column``, ``Select``, ``Sort_Values``, ``Head``, ``Tail`` and
+``GroupBy`` do not compute their results. They output an :class:`H5` that
+carries a plan instead, which is only executed when a cell reads the data.
+Leading column selections and ``where`` clauses in a plan are pushed down
+into the data store query.
+"""
+
+asynchronous = False
+"""
+If True, cells and operators that run on a worker return their :class:`H5`
+as soon as the task is submitted. Reading the H5 waits for the worker to
+finish, so downstream cells only block when they need the data and
+independent branches of a circuit run at the same time. Errors are raised
+when the H5 is read. See :meth:`H5.wait`.
+"""
+
+executor = None
+"""
+The threads that wait on workers for :data:`asynchronous` cells. It is created
+by the first task, with as many threads as :data:`~PyCell.worker_pool.pool`
+has workers, and replaced if the pool is resized.
+"""
+
+_pending = {}
+_pending_lock = threading.Lock()
+_executor_size = None
+
+
+def _executor():
+    """
+    *Internal*. Returns :data:`executor`, creating it for the current size of
+    the pool.
+    """
+    global executor, _executor_size
+    with _pending_lock:
+        if executor is None or _executor_size != pool.size:
+            if executor is not None:
+                # queued and running tasks still finish
+                executor.shutdown(wait=False)
+            executor = ThreadPoolExecutor(max_workers=pool.size)
+            _executor_size = pool.size
+        return executor
+
+
+def _submit(file, node, func):
+    """
+    *Internal*. Runs ``func`` on :data:`executor` and registers it as the
+    task that produces ``node`` of ``file``. Its phases are added to the
+    record of the cell that submitted it.
+    """
+    key = (file, node)
+    record = profiler.current
+
+    def run():
+        with profiler.attach(record):
+            func()
+    future = _executor().submit(run)
+    with _pending_lock:
+        _pending[key] = (os.getpid(), future)
+
+    def done(future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            print(future.exception())
+            print("Error creating {}".format(file))
+            return
+        # failed tasks stay registered so that readers see the error
+        with _pending_lock:
+            if _pending.get(key, (None, None))[1] is future:
+                del _pending[key]
+    future.add_done_callback(done)
+
+
+def _forget(file, node):
+    """
+    *Internal*. Drops any task registered for ``node`` of ``file``.
+    """
+    with _pending_lock:
+        _pending.pop((file, node), None)
+
+
+_readers = {}
+
+
+def cancel(file=None, node=None):
+    """
+    Stops the tasks that produce ``node`` of ``file``, or every task if
+    ``file`` is ``None``. Running workers and csv readers are terminated and
+    queued :data:`asynchronous` tasks are dropped. Whatever the tasks wrote is
+    removed.
+
+    :returns: The number of tasks stopped.
+    :rtype: int
+    """
+    tag = None if file is None else (file, node)
+    count = pool.cancel(tag)
+    with _pending_lock:
+        futures = [f for key, (pid, f) in _pending.items()
+                   if (tag is None or key == tag) and pid == os.getpid()]
+        readers = [(key, p) for key, p in _readers.items()
+                   if tag is None or key == tag]
+    for future in futures:
+        if future.cancel():
+            count += 1
+    for key, p in readers:
+        if p.is_alive():
+            p.terminate()
+            count += 1
+    return count
+
+
+def _cleanup(file, node):
+    """
+    *Internal*. Removes what a failed or cancelled task left of ``node``: its
+    frame in :data:`results`, any dumped column buffers, and a partially
+    written node in the data store. A store file that cannot be opened is
+    removed.
+    """
+    results.discard(file, node)
+    frame_cache.invalidate(file, node)
+    path = os.path.join(plugin_cache, file)
+    if not os.path.exists(path):
+        return
+    try:
+        with pd.HDFStore(path) as store:
+            if node in store:
+                store.remove(node)
+            empty = not store.keys()
+    except Exception:
+        empty = True
+    if empty:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def wait_all():
+    """
+    Blocks until every :data:`asynchronous` task has finished.
+    """
+    with _pending_lock:
+        futures = [f for pid, f in _pending.values() if pid == os.getpid()]
+    for future in futures:
+        try:
+            future.result()
+        except Exception:
+            pass
+
+
+def storage_options(storage=None):
+    """
+    Resolves a storage policy to a dict of options. ``storage`` may be the
+    name of a policy in :data:`storage_policies`, a dict of options, or
+    ``None`` for :data:`default_storage`.
+    """
+    if storage is None:
+        storage = default_storage
+    if isinstance(storage, str):
+        storage = storage_policies[storage]
+    return dict(storage)
+
+
+def _nbytes(df):
+    """
+    *Internal*. Approximate memory footprint of a DataFrame or Series.
+    """
+    usage = df.memory_usage(deep=True)
+    try:
+        return int(usage.sum())
+    except AttributeError:
+        return int(usage)
+
+
+def frame_path(file, node):
+    """
+    Returns the directory used to pass the frame at ``(file, node)`` between
+    processes with :func:`dump_frame` and :func:`load_frame`.
+    """
+    name = '{}-{}.frame'.format(os.path.splitext(file)[0],
+                                node.strip('/').replace('/', '_'))
+    return os.path.join(plugin_cache, name)
+
+
+def dump_frame(df, path, **kwargs):
+    """
+    Writes the column buffers of a DataFrame or Series to ``path`` so that
+    another process can map them with :func:`load_frame`. Columns with a plain
+    NumPy dtype are saved as uncompressed ``.npy`` files. Other columns, the
+    index and ``kwargs`` are pickled alongside.
+
+    Any previous contents of ``path`` are unlinked rather than overwritten, so
+    frames already mapped from it stay valid.
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    series = isinstance(df, pd.Series)
+    frame = df.to_frame() if series else df
+    values = []
+    for i in range(frame.shape[1]):
+        col = frame.iloc[:, i]
+        if isinstance(col.dtype, np.dtype) and col.dtype.kind in 'biufcmM':
+            np.save(os.path.join(path, '{}.npy'.format(i)), col.values,
+                    allow_pickle=False)
+            values.append(None)
+        else:
+            values.append(col.values)
+    meta = {'series': series, 'name': df.name if series else None,
+            'index': frame.index, 'columns': frame.columns,
+            'values': values, 'kwargs': kwargs}
+    with open(os.path.join(path, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+    profiler.add('bytes_out', _nbytes(df))
+    cache.written(os.path.basename(path))
+
+
+def load_frame(path):
+    """
+    Rebuilds a frame written by :func:`dump_frame`. NumPy columns are memory
+    mapped copy-on-write, so they are not read until used and modifying them
+    does not change the files.
+
+    :returns: The frame and the keyword arguments it was dumped with.
+    :rtype: tuple
+    """
+    with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+        meta = pickle.load(f)
+    data = OrderedDict()
+    for i, values in enumerate(meta['values']):
+        if values is None:
+            values = np.load(os.path.join(path, '{}.npy'.format(i)),
+                             mmap_mode='c')
+        data[i] = values
+    if meta['series']:
+        df = pd.Series(data[0], index=meta['index'], name=meta['name'],
+                       copy=False)
+    else:
+        df = pd.DataFrame(data, index=meta['index'], copy=False)
+        df.columns = meta['columns']
+    return df, meta['kwargs']
+
+
+class ResultStore(object):
+    """
+    In-memory table of dataframe results keyed by store file and node. Cells
+    that run in the main process put their results here so that the next cell
+    can read them without a round trip through HDF5. When the total size of
+    the frames held exceeds ``budget``, the least recently used frames are
+    spilled to the H5 cache and dropped from memory.
+
+    Frames cross process boundaries through :func:`dump_frame`. A frame that
+    is exported here, or dumped by a worker, is mapped back in on the first
+    :meth:`get` instead of being read from HDF5.
+
+    This class is thread-safe. A process forked from the owner starts with an
+    empty store.
+
+    :param budget: Maximum number of bytes held in memory.
+    :type budget: int
+    """
+    def __init__(self, budget=512 * 2**20):
+        self.budget = budget
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+        self._frames = OrderedDict()
+        self._nbytes = 0
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def __contains__(self, key):
+        self._check_fork()
+        with self._lock:
+            return key in self._frames
+
+    def keys(self):
+        """
+        Returns the ``(file, node)`` of every frame held in memory.
+        """
+        self._check_fork()
+        with self._lock:
+            return list(self._frames)
+
+    @property
+    def nbytes(self):
+        """The number of bytes currently held in memory."""
+        return self._nbytes
+
+    def put(self, file, node, df, **kwargs):
+        """
+        Stores ``df`` under ``(file, node)``. Keyword arguments are kept and
+        passed on to :meth:`H5.write_store` if the frame is spilled.
+        """
+        self._check_fork()
+        with self._lock:
+            self.discard(file, node)
+            self._insert(file, node, df, kwargs, exported=False)
+
+    def get(self, file, node):
+        """
+        Returns the frame stored under ``(file, node)`` or ``None``.
+        """
+        self._check_fork()
+        key = (file, node)
+        with self._lock:
+            entry = self._frames.get(key)
+            if entry is None:
+                return self.load(file, node)
+            self._frames.move_to_end(key)
+            return entry[0]
+
+    def load(self, file, node):
+        """
+        Maps in a frame dumped for ``(file, node)`` by another process,
+        replacing any frame held in memory under the same key.
+
+        :returns: The frame, or ``None`` if nothing was dumped.
+        """
+        self._check_fork()
+        path = frame_path(file, node)
+        if not os.path.isdir(path):
+            return None
+        with self._lock:
+            self._pop((file, node))
+            df, kwargs = load_frame(path)
+            self._insert(file, node, df, kwargs, exported=True)
+        cache.written(os.path.basename(path))
+        return df
+
+    def export(self, file, node):
+        """
+        Dumps a frame held in memory so that other processes can load it.
+        """
+        self._check_fork()
+        with self._lock:
+            entry = self._frames.get((file, node))
+            if entry is not None and not entry[4]:
+                dump_frame(entry[0], frame_path(file, node), **entry[2])
+                entry[4] = True
+
+    def options(self, file, node):
+        """
+        Returns the storage keyword arguments recorded with a frame.
+        """
+        self._check_fork()
+        with self._lock:
+            entry = self._frames.get((file, node))
+            return {} if entry is None else entry[2]
+
+    def flush(self, file, node):
+        """
+        Writes a frame to the H5 cache if it has not been written yet. The
+        frame stays in memory.
+        """
+        self._check_fork()
+        with self._lock:
+            entry = self._frames.get((file, node))
+            if entry is not None and entry[3]:
+                H5.write_store(entry[0], file, node, **entry[2])
+                entry[3] = False
+
+    def discard(self, file, node):
+        """
+        Drops a frame from memory without writing it.
+        """
+        self._check_fork()
+        with self._lock:
+            self._pop((file, node))
+            shutil.rmtree(frame_path(file, node), ignore_errors=True)
+
+    def reset(self):
+        """
+        Forgets every frame without writing it or removing its dump.
+        """
+        self._check_fork()
+        with self._lock:
+            self._frames.clear()
+            self._nbytes = 0
+
+    def clear(self):
+        """
+        Spills every unwritten frame and empties the store.
+        """
+        self._check_fork()
+        with self._lock:
+            for file, node in list(self._frames):
+                self.flush(file, node)
+                self.discard(file, node)
+
+    def _insert(self, file, node, df, kwargs, exported):
+        self._frames[(file, node)] = [df, _nbytes(df), kwargs, True,
+                                      exported]
+        self._nbytes += self._frames[(file, node)][1]
+        self._evict()
+
+    def _pop(self, key):
+        entry = self._frames.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry[1]
+        return entry
+
+    def _evict(self):
+        while self._nbytes > self.budget and self._frames:
+            file, node = next(iter(self._frames))
+            self.flush(file, node)
+            self.discard(file, node)
+
+
+results = ResultStore()
+"""The store shared by all dataframe cells in this process."""
+
+
+class FrameCache(object):
+    """
+    Least recently used cache of frames and metadata read from the H5 cache.
+    Entries are keyed by file, node and the file's modification time, so a
+    node rewritten by another process is never served stale. Writes from this
+    process invalidate their node explicitly.
+
+    This class is thread-safe. A process forked from the owner starts with an
+    empty cache.
+
+    :param budget: Maximum number of bytes of frames held.
+    :type budget: int
+    :param maxsize: Maximum number of nodes held.
+    :type maxsize: int
+    """
+    def __init__(self, budget=256 * 2**20, maxsize=64):
+        self.budget = budget
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._nbytes = 0
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _key(self, file, node):
+        path = os.path.join(plugin_cache, file)
+        try:
+            return (path, node, os.stat(path).st_mtime_ns)
+        except OSError:
+            return None
+
+    def get(self, file, node, field='df'):
+        """
+        Returns a cached ``field`` of ``(file, node)`` or ``None``.
+        """
+        self._check_fork()
+        key = self._key(file, node)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or field not in entry:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[field]
+
+    def put(self, file, node, value, field='df'):
+        """
+        Caches ``value`` as ``field`` of ``(file, node)``. Frames larger than
+        the budget are not cached.
+        """
+        self._check_fork()
+        key = self._key(file, node)
+        size = _nbytes(value) if field == 'df' else 0
+        if key is None or size > self.budget:
+            return
+        with self._lock:
+            entry = self._entries.setdefault(key, {})
+            if field == 'df' and 'df' in entry:
+                self._nbytes -= _nbytes(entry['df'])
+            entry[field] = value
+            self._entries.move_to_end(key)
+            self._nbytes += size
+            while (self._nbytes > self.budget or
+                   len(self._entries) > self.maxsize):
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, file, node=None):
+        """
+        Drops every entry of ``node`` in ``file``, or of the whole file if
+        ``node`` is ``None``.
+        """
+        self._check_fork()
+        path = os.path.join(plugin_cache, file)
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == path and node in (None, key[1]):
+                    self._drop(key)
+
+    def clear(self):
+        self._check_fork()
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        if 'df' in entry:
+            self._nbytes -= _nbytes(entry['df'])
+
+
+frame_cache = FrameCache()
+"""The cache shared by all :class:`H5` objects in this process."""
+
+
+class CacheManager(object):
+    """
+    Manages the files and frame dumps in a cache directory. It counts the
+    live :class:`H5` objects for each file, keeps the least recently used
+    order of everything in the cache, and removes entries that nothing
+    refers to when the cache grows past ``budget``.
+
+    An entry is never removed while an H5 for it is alive, a frame of it is
+    held in :data:`results`, or a task is still writing it. Temporary results
+    named by :meth:`unique` are removed by :meth:`cleanup` as soon as no H5
+    refers to them.
+
+    Only the process that created the manager removes files, so workers
+    never delete what the parent is using.
+
+    :param budget: Bytes of disk the cache may use. ``None`` for no limit.
+    :type budget: int or None
+    :param path: The directory managed. Defaults to :data:`plugin_cache`.
+    :type path: string
+    """
+    prefix = 'tmp_'
+    """The prefix of names made by :meth:`unique`."""
+
+    def __init__(self, budget=10 * 2**30, path=None):
+        self.budget = budget
+        self.path = path or plugin_cache
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+        self._refs = {}
+        self._entries = None
+        self._timer = None
+        self._due = None
+
+    def _active(self):
+        return os.getpid() == self._pid
+
+    def _scan(self):
+        # oldest first, so that entries from earlier sessions go first
+        if self._entries is not None:
+            return
+        names = []
+        for name in os.listdir(self.path):
+            try:
+                names.append((os.stat(os.path.join(self.path,
+                                                   name)).st_mtime, name))
+            except OSError:
+                pass
+        self._entries = OrderedDict()
+        for mtime, name in sorted(names):
+            self._entries[name] = self._size(name)
+
+    def _size(self, name):
+        path = os.path.join(self.path, name)
+        if not os.path.isdir(path):
+            try:
+                return os.path.getsize(path)
+            except OSError:
+                return 0
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, f))
+                except OSError:
+                    pass
+        return total
+
+    @property
+    def nbytes(self):
+        """The number of bytes used by the cache."""
+        with self._lock:
+            self._scan()
+            return sum(self._entries.values())
+
+    def unique(self, name):
+        """
+        Returns a new node name based on ``name`` that does not collide with
+        any other. The result is temporary: it is removed by :meth:`cleanup`
+        once no H5 refers to it.
+        """
+        return '{}{}_{}'.format(self.prefix, name, uuid.uuid4().hex[:16])
+
+    def acquire(self, file):
+        """
+        Records a live reference to ``file``.
+        """
+        with self._lock:
+            self._refs[file] = self._refs.get(file, 0) + 1
+
+    def release(self, file):
+        """
+        Drops a reference recorded by :meth:`acquire`.
+        """
+        with self._lock:
+            count = self._refs.get(file, 0) - 1
+            if count > 0:
+                self._refs[file] = count
+            else:
+                self._refs.pop(file, None)
+
+    def touch(self, name):
+        """
+        Marks ``name`` as recently used.
+        """
+        if not self._active():
+            return
+        with self._lock:
+            self._scan()
+            if name in self._entries:
+                self._entries.move_to_end(name)
+
+    def written(self, name):
+        """
+        Records that ``name`` was written and removes unused entries if the
+        cache is over budget.
+        """
+        if not self._active():
+            return
+        with self._lock:
+            self._scan()
+            self._entries.pop(name, None)
+            self._entries[name] = self._size(name)
+        self.enforce()
+
+    def _busy(self):
+        """
+        Returns the names that must not be removed.
+        """
+        # called without holding our lock, as results takes its own lock and
+        # may call back into the cache
+        with self._lock:
+            busy = set(self._refs)
+        for file, node in results.keys():
+            busy.add(file)
+            busy.add(os.path.basename(frame_path(file, node)))
+        with _pending_lock:
+            tasks = list(_pending) + list(_readers)
+        for tag in tasks + pool.running():
+            if isinstance(tag, tuple) and len(tag) == 2:
+                busy.add(tag[0])
+                busy.add(os.path.basename(frame_path(*tag)))
+        return busy
+
+    def remove(self, name):
+        """
+        Deletes ``name`` from the cache.
+        """
+        path = os.path.join(self.path, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        frame_cache.invalidate(name)
+        with self._lock:
+            if self._entries is not None:
+                self._entries.pop(name, None)
+
+    def enforce(self):
+        """
+        Removes the least recently used entries that are not in use until the
+        cache fits its budget.
+
+        :returns: The number of entries removed.
+        :rtype: int
+        """
+        if not self._active() or self.budget is None:
+            return 0
+        if self.nbytes <= self.budget:
+            return 0
+        busy = self._busy()
+        removed = 0
+        with self._lock:
+            total = sum(self._entries.values())
+            for name in list(self._entries):
+                if total <= self.budget:
+                    break
+                if name in busy:
+                    continue
+                total -= self._entries[name]
+                self.remove(name)
+                removed += 1
+        return removed
+
+    def cleanup(self, grace=60):
+        """
+        Removes temporary results and frame dumps that are no longer in use,
+        then enforces the budget.
+
+        :param grace: Entries modified in the last ``grace`` seconds are kept,
+                      as a task may be about to read them.
+        :type grace: float
+        :returns: The number of entries removed.
+        :rtype: int
+        """
+        if not self._active():
+            return 0
+        busy = self._busy()
+        removed = 0
+        with self._lock:
+            self._entries = None
+            self._scan()
+            for name in list(self._entries):
+                if name in busy:
+                    continue
+                if not (name.startswith(self.prefix) or
+                        name.endswith('.frame')):
+                    continue
+                try:
+                    mtime = os.stat(os.path.join(self.path, name)).st_mtime
+                except OSError:
+                    continue
+                if time.time() - mtime >= grace:
+                    self.remove(name)
+                    removed += 1
+        return removed + self.enforce()
+
+    def schedule(self, delay=1.0):
+        """
+        Runs :meth:`cleanup` once ``delay`` seconds pass without another call,
+        so stopping every cell of a circuit runs a single pass. Later calls
+        only move the deadline; the pending timer is reused.
+        """
+        if not self._active():
+            return
+        with self._lock:
+            self._due = time.monotonic() + delay
+            if self._timer is None:
+                self._start_timer(delay)
+
+    def _start_timer(self, delay):
+        self._timer = threading.Timer(delay, self._scheduled)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _scheduled(self):
+        with self._lock:
+            remaining = self._due - time.monotonic()
+            if remaining > 0:
+                self._start_timer(remaining)
+                return
+            self._timer = None
+        self.cleanup()
+
+
+cache = CacheManager()
+"""The manager of :data:`plugin_cache` for this process."""
+
+
+@on_stop
+def _cleanup_cache(cell):
+    cache.schedule()
+
+
+_tasks = {}
+
+
+def _register_task(func):
+    """
+    *Internal*. Records an undecorated cell function so that a worker process
+    can look it up by name. The decorated function replaces the original on
+    its class, so the original cannot be pickled by reference.
+    """
+    key = (func.__module__, func.__qualname__)
+    _tasks[key] = func
+    return key
+
+
+def _lookup_task(key):
+    if key not in _tasks:
+        importlib.import_module(key[0])
+    return _tasks[key]
+
+
+def _cell_state(cell):
+    """
+    *Internal*. Returns a picklable snapshot of the parts of a cell that a
+    worker needs to run one of its functions.
+    """
+    inputs = cell.inputs
+    if isinstance(inputs, ValidInputs):
+        inputs = {k: v.value for k, v in inputs.items()}
+    else:
+        inputs = dict(inputs)
+    return (type(cell), cell.py_id, inputs)
+
+
+def _restore_cell(cls, py_id, inputs):
+    cell = cls.__new__(cls)
+    cell.py_id = py_id
+    if isinstance(cls.inputs, ValidInputs):
+        inputs = ValidInputs(inputs)
+    cell.inputs = inputs
+    return cell
+
+
+def _run_data_task(key, state, file, node, storage, *args, **kwargs):
+    """
+    *Internal*. Worker side of :func:`data_process`.
+    """
+    func = _lookup_task(key)
+    # frames mapped in by an earlier task may have been replaced since
+    results.reset()
+    cell = _restore_cell(*state)
+    with profiler.capture() as stats:
+        with profiler.phase('compute'):
+            df = func(cell, *args, **kwargs)
+        with profiler.phase('write'):
+            results.discard(file, node)
+            dump_frame(df, frame_path(file, node),
+                       data_columns=args[0].data_columns, storage=storage)
+    return stats
+
+
+def _run_partial_groupby(file, node, start, stop, columns, needs):
+    """
+    *Internal*. Worker side of a partitioned :class:`GroupBy`. Reads rows
+    ``start`` to ``stop`` of ``node`` and returns their partial aggregates.
+    """
+    df = pd.read_hdf(os.path.join(plugin_cache, file), node, start=start,
+                     stop=stop)
+    return GroupBy.partials(df, columns, needs)
+
+
+def _run_bucket_task(file, node, keys, dtypes, buckets, out,
+                     chunksize=500000):
+    """
+    *Internal*. Worker side of a bucketed :class:`Merge`. Reads ``node`` in
+    chunks and appends the rows of each chunk to node ``b{bucket}_{chunk}`` of
+    ``out``, choosing the bucket from a hash of the ``keys`` columns cast to
+    ``dtypes``. An empty ``schema`` node keeps the columns and types for empty
+    buckets.
+    """
+    path = os.path.join(plugin_cache, file)
+    with pd.HDFStore(path, mode='r') as store:
+        table = getattr(store.get_storer(node), 'is_table', False)
+    if table:
+        chunks = pd.read_hdf(path, node, chunksize=chunksize)
+    else:
+        chunks = [pd.read_hdf(path, node)]
+    options = storage_options('fast')
+    options.pop('format', None)
+    with pd.HDFStore(os.path.join(plugin_cache, out), mode='w',
+                     **options) as store:
+        # before the chunks, as an empty table has none
+        store.put('schema', pd.read_hdf(path, node, start=0, stop=0),
+                  format='fixed')
+        for n, chunk in enumerate(chunks):
+            bucket = pd.util.hash_pandas_object(
+                chunk[keys].astype(dict(zip(keys, dtypes))), index=False)
+            bucket = bucket.values % buckets
+            for b in np.unique(bucket):
+                store.put('b{}_{}'.format(b, n), chunk[bucket == b],
+                          format='fixed')
+    return True
+
+
+def _read_bucket(file, bucket):
+    """
+    *Internal*. Reads one bucket written by :func:`_run_bucket_task`.
+    """
+    prefix = '/b{}_'.format(bucket)
+    with pd.HDFStore(os.path.join(plugin_cache, file), mode='r') as store:
+        frames = [store['schema']] + [store[key] for key in store.keys()
+                                      if key.startswith(prefix)]
+    return pd.concat(frames)
+
+
+def _run_bucket_join(left, right, bucket, kwargs, index, file, node):
+    """
+    *Internal*. Worker side of a bucketed :class:`Merge`. Joins one pair of
+    buckets and hands the result back with :func:`dump_frame`.
+    """
+    df = _read_bucket(left, bucket).merge(_read_bucket(right, bucket),
+                                          **kwargs)
+    df.set_index(index, inplace=True)
+    dump_frame(df, frame_path(file, node))
+    return True
+
+
+def _run_operator_task(key, node, *args, **kwargs):
+    """
+    *Internal*. Worker side of :func:`operator_process`.
+    """
+    func = _lookup_task(key)
+    results.reset()
+    with profiler.capture() as stats:
+        with profiler.phase('compute'):
+            df = func(*args, **kwargs)
+        with profiler.phase('write'):
+            results.discard('{}.h5'.format(node), node)
+            dump_frame(df, frame_path('{}.h5'.format(node), node))
+    return stats
+
 
 def data_process(func):
     """
@@ -160,49 +1112,148 @@ def data_process(func):
     where it is expected to be put into an output socket for the next cell to
     use.
 
+    Cells that are ``threadsafe`` run the decorated function in the calling
+    process and keep the result in :data:`results` instead of writing it to
+    the data store.
+
+    If the result is written to the data store, it uses the policy named by
+    the cell's ``storage`` attribute, or :data:`default_storage` if the cell
+    has none. See :data:`storage_policies`.
+
     .. note::
-       This decorator runs the decorated function in a separate processor and
-       therefore, will not emit any print statements.
+       Other cells run the decorated function on a worker from
+       :data:`~PyCell.worker_pool.pool` and therefore, will not emit any print
+       statements. The worker hands its result back with :func:`dump_frame`.
+
+    The time spent is added to the cell's record in
+    :data:`~PyCell.custom_cell.profiler` as the phases ``compute``, ``write``,
+    ``dispatch`` (the round trip to a worker) and ``read``.
     """
+    key = _register_task(func)
+
     def process_func(*args, **kwargs):
 #        assert isinstance(args[0], Custom), 'args[0] must be self'
         file = '{}.h5'.format(args[0].py_id)
         node = 'c{}'.format(args[0].py_id)
         if not isinstance(args[1], H5):
             raise TypeError('args[1] must be an H5')
+        storage = getattr(args[0], 'storage', None)
 
-        @exception_raiser
-        def multi_process(conn, file, node, func, *new_args, **kwargs):
+        if args[0].threadsafe:
             try:
-                df = func(*args, **kwargs)
-                data_cols = args[1].data_columns
-                H5(file, node, df, data_columns=data_cols)
-                conn.send(True)
-            except:
+                with profiler.phase('compute'):
+                    df = exception_raiser(func)(*args, **kwargs)
+                with profiler.phase('write'):
+                    results.put(file, node, df,
+                                data_columns=args[1].data_columns,
+                                storage=storage)
+                new_h5 = H5(file, node)
+            except Exception as e:
                 print("Error creating {}".format(file))
-                conn.send(False)
+                args[0].fail(describe(e))
+                new_h5 = None
+            return new_h5
+
+        largs = (key, _cell_state(args[0]), file, node, storage, *args[1:])
+        timeout = getattr(args[0], 'timeout', None)
+
+        def run():
+            try:
+                with profiler.phase('dispatch'):
+                    stats = pool.apply(_run_data_task, largs, kwargs,
+                                       timeout=timeout, tag=(file, node))
+                profiler.merge(stats)
+                with profiler.phase('read'):
+                    results.load(file, node)
+            except Exception:
+                _cleanup(file, node)
                 raise
 
-        parent_conn, child_conn = Pipe()
-        largs = (child_conn, file, node, func, *args)
-        p = Process(target=multi_process, args=largs, kwargs=kwargs)
-        p.start()
-        p.join(10)
-        if parent_conn.recv():
+        if asynchronous:
+            _submit(file, node, run)
+            return H5(file, node)
+        _forget(file, node)
+        try:
+            run()
             new_h5 = H5(file, node)
-        else:
+        except Exception as e:
+            # includes errors sending the task, such as a PicklingError
+            print(e)
             print("Error creating {}".format(file))
+            args[0].fail(describe(e))
             new_h5 = None
         return new_h5
     return process_func
 
 
+comparisons = {'eq': '==', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>',
+               'ge': '>='}
+"""Comparison operators of :class:`H5` that can be evaluated by the store."""
+
+
+def _predicate(op, left, right):
+    """
+    *Internal*. Returns ``(file, node, condition)`` if ``left <op> right`` can
+    be written as an HDFStore ``where`` condition on ``node``, else ``None``.
+    A comparison qualifies if ``left`` is a column selected from a table in
+    the data store and indexed as a data column, and ``right`` is a scalar.
+    Frames held in :data:`results` are compared in memory. ``&`` and ``|``
+    combine conditions on the same node.
+    """
+    if not isinstance(left, H5):
+        return None
+    if op in comparisons:
+        if left.source is None:
+            return None
+        file, node, column = left.source
+        source = H5(file, node)
+        # querying a frame held in memory would write it to the store first
+        if source.in_memory or not source.is_table:
+            return None
+        if isinstance(right, np.generic):
+            # the repr of a numpy scalar is not a literal under numpy 2
+            right = right.item()
+        if isinstance(right, float) and not np.isfinite(right):
+            return None
+        # the condition refers to the column by name
+        if not (isinstance(column, str) and column.isidentifier() and
+                isinstance(right, (str, bool, int, float)) and
+                column in source.data_columns):
+            return None
+        return file, node, '{} {} {!r}'.format(column, comparisons[op], right)
+    if op in ('and', 'or') and isinstance(right, H5):
+        if (left.condition is None or right.condition is None or
+                (left.file, left.node) != (right.file, right.node)):
+            return None
+        return left.file, left.node, '({}) {} ({})'.format(
+            left.condition, '&' if op == 'and' else '|', right.condition)
+    return None
+
+
 def operator_process(op):
     """
-    Documentation coming soon.
+    Decorator for the arithmetic and comparison operators of :class:`H5`. The
+    operator runs on a worker from :data:`~PyCell.worker_pool.pool` and its
+    result is written to a new temporary node named after ``op``. If
+    the left operand is held in :data:`results`, the operator runs in the
+    calling process and its result stays in memory.
+
+    Comparisons that can be evaluated by the store (see :data:`comparisons`)
+    are not computed. They return an H5 that carries the ``where`` condition
+    in :attr:`H5.condition`, and the boolean Series is only built if it is
+    read.
     """
     def do_func(func):
+        key = _register_task(func)
+
         def process_operator(*args, **kwargs):
+            predicate = _predicate(op, *args)
+            if predicate is not None:
+                file, node, condition = predicate
+                new_h5 = H5(file, node).defer('mask', condition)
+                new_h5.condition = condition
+                return new_h5
+
             new_args = list(args)
             try:
                 # convert the second argument to a df if it's an H5
@@ -210,27 +1261,44 @@ def operator_process(op):
             except:
                 pass
             finally:
-                node2 = '{}_{}_{}'.format(op, id(args[0]), id(args[1]))
+                node2 = cache.unique(op)
 
-            @exception_raiser
-            def multi_operate(conn, node, func, *args, **kwargs):
+            if args[0].in_memory:
                 try:
-                    df = func(*args, **kwargs)
-                    H5('{}.h5'.format(node), node, df)
-                    conn.send(True)
-                except:
-                    print("Error creating {}.h5".format(node))
-                    conn.send(False)
+                    with profiler.phase('compute'):
+                        df = exception_raiser(func)(*new_args, **kwargs)
+                    with profiler.phase('write'):
+                        results.put('{}.h5'.format(node2), node2, df)
+                    new_h5 = H5('{}.h5'.format(node2), node2)
+                except Exception:
+                    print("Error creating {}.h5".format(node2))
+                    new_h5 = None
+                return new_h5
+
+            largs = (key, node2, *new_args)
+
+            def run():
+                file = '{}.h5'.format(node2)
+                try:
+                    with profiler.phase('dispatch'):
+                        stats = pool.apply(_run_operator_task, largs, kwargs,
+                                           tag=(file, node2))
+                    profiler.merge(stats)
+                    with profiler.phase('read'):
+                        results.load(file, node2)
+                except Exception:
+                    _cleanup(file, node2)
                     raise
 
-            parent_conn, child_conn = Pipe()
-            largs = (child_conn, node2, func, *new_args)
-            p = Process(target=multi_operate, args=largs, kwargs=kwargs)
-            p.start()
-            p.join()
-            if parent_conn.recv():
+            if asynchronous:
+                _submit('{}.h5'.format(node2), node2, run)
+                return H5('{}.h5'.format(node2), node2)
+            _forget('{}.h5'.format(node2), node2)
+            try:
+                run()
                 new_h5 = H5('{}.h5'.format(node2), node2)
-            else:
+            except Exception as e:
+                print(e)
                 print("Error creating {}.h5".format(node2))
                 new_h5 = None
             return new_h5
@@ -242,7 +1310,9 @@ def operator_process(op):
 class H5(object):
     """
     Proxy object for hdf5 storage. Used as a lightweight communication object
-    between dataframe cell sockets.
+    between dataframe cell sockets. If the node is held in :data:`results`,
+    the frame is served from memory and only written to the data store when
+    an operation needs it there.
 
     :param node: A group label.
     :type node: string
@@ -250,18 +1320,233 @@ class H5(object):
 #     write_lock = Lock()
 
     @classmethod
-    def write_store(cls, df, file, node, **kwargs):
-        store = pd.HDFStore(os.path.join(plugin_cache, file), complevel=9,
-                            complib='blosc')
-        store.put(node, df, format='table', **kwargs)
+    def write_store(cls, df, file, node, storage=None, **kwargs):
+        """
+        Writes ``df`` to ``node`` of ``file`` in the H5 cache.
+
+        :param storage: The storage policy to write with. See
+                        :func:`storage_options`.
+        :type storage: str or dict
+        """
+        options = storage_options(storage)
+        fmt = options.pop('format', 'table')
+        if fmt == 'fixed':
+            # only tables have indexed columns
+            kwargs.pop('data_columns', None)
+            kwargs.pop('min_itemsize', None)
+        frame_cache.invalidate(file, node)
+        store = pd.HDFStore(os.path.join(plugin_cache, file), **options)
+        store.put(node, df, format=fmt, **kwargs)
         store.close()
+        profiler.add('bytes_out', _nbytes(df))
+        cache.written(file)
+
+    @classmethod
+    def write_chunks(cls, chunks, file, node, storage=None, progress=None,
+                     **kwargs):
+        """
+        Writes an iterable of frames to ``node`` of ``file`` one at a time, so
+        only one chunk is held in memory. The node is always written as a
+        table, whatever the format of the storage policy.
+
+        :param progress: Called with the total number of rows written after
+                         each chunk.
+        :type progress: callable
+        :returns: The number of rows written.
+        :rtype: int
+        """
+        options = storage_options(storage)
+        options.pop('format', None)
+        frame_cache.invalidate(file, node)
+        rows = 0
+        store = pd.HDFStore(os.path.join(plugin_cache, file), **options)
+        try:
+            if node in store:
+                store.remove(node)
+            for chunk in chunks:
+                store.append(node, chunk, format='table', **kwargs)
+                rows += len(chunk)
+                profiler.add('bytes_out', _nbytes(chunk))
+                if progress is not None:
+                    progress(rows)
+        finally:
+            store.close()
+            cache.written(file)
+        return rows
+
+    plan = ()
+    """
+    Operations still to be applied to the node, as ``(op, *args)`` tuples.
+    See :meth:`defer`.
+    """
+    _result = None
+    source = None
+    """
+    ``(file, node, column)`` if this is a Series selected from a column of
+    another node. Set by :class:`Column`.
+    """
+    condition = None
+    """
+    A ``where`` condition on this H5's node that selects the rows where this
+    boolean Series is True. :class:`Select` pushes it down into the store.
+    """
 
     def __init__(self, file, node='/', df=None, **kwargs):
         if df is not None:
+            results.discard(file, node)
             H5.write_store(df, file, node, **kwargs)
         self.node = node
         """The node that this H5 object represents."""
         self.file = file
+        cache.acquire(file)
+        weakref.finalize(self, cache.release, file)
+
+    def __getstate__(self):
+        if self.plan:
+            return self.materialize().__getstate__()
+        self.wait()
+        # a worker process cannot see our memory, so map the frame out before
+        # this proxy is sent to one
+        results.export(self.file, self.node)
+        return self.__dict__
+
+    def defer(self, op, *args):
+        """
+        Returns a new H5 with ``(op, *args)`` appended to this one's plan. The
+        supported operations are:
+
+        - ``('columns', columns)``: select a column or list of columns.
+        - ``('where', expression)``: filter rows with an HDFStore ``where``
+          expression.
+        - ``('sort', columns)``: sort by a list of columns, or a Series by its
+          values if ``columns`` is empty.
+        - ``('head', n)`` and ``('tail', n)``: keep the first or last rows.
+        - ``('groupby', columns, aggregation)``: group and summarize as in
+          :class:`GroupBy`.
+        - ``('mask', condition)``: evaluate a ``where`` condition to a boolean
+          Series.
+        """
+        h5 = H5(self.file, self.node)
+        h5.plan = self.plan + ((op,) + args,)
+        return h5
+
+    def materialize(self):
+        """
+        Executes the plan and returns an H5 for its result, which is held in
+        :data:`results`. The plan is only executed once per H5. Returns
+        ``self`` if there is no plan.
+        """
+        if not self.plan:
+            return self
+        if self._result is None:
+            df, data_columns = self._execute()
+            # a new file, so the input's store is never written to
+            node = cache.unique('plan')
+            results.put('{}.h5'.format(node), node, df,
+                        data_columns=data_columns)
+            self._result = H5('{}.h5'.format(node), node)
+        return self._result
+
+    def _execute(self):
+        base = H5(self.file, self.node)
+        steps = list(self.plan)
+        columns = None
+        where = []
+        # push leading projections and filters down into the store query
+        while steps and steps[0][0] in ('columns', 'where'):
+            op, arg = steps.pop(0)
+            if op == 'where':
+                where.append(arg)
+            else:
+                columns = arg
+        series = isinstance(columns, str)
+        if where or (columns is not None and not base.in_memory and
+                     base.is_table):
+            kwargs = {'where': where or None}
+            if columns is not None:
+                kwargs['columns'] = [columns] if series else list(columns)
+            df = base.select(**kwargs)
+        else:
+            df = base.df
+            if columns is not None:
+                df = df.loc[:, [columns] if series else list(columns)]
+        if series:
+            df = df[columns]
+
+        for step in steps:
+            op, args = step[0], step[1:]
+            if op == 'columns':
+                df = df.loc[:, args[0]]
+            elif op == 'where':
+                df = df.query(args[0])
+            elif op == 'sort':
+                if isinstance(df, pd.Series):
+                    df = df.sort_values()
+                else:
+                    df = df.sort_values(args[0])
+            elif op == 'head':
+                df = df.head(args[0])
+            elif op == 'tail':
+                df = df.tail(args[0])
+            elif op == 'groupby':
+                df = GroupBy.aggregate(df, *args)
+            elif op == 'mask':
+                df = df.eval(args[0])
+            else:
+                raise ValueError('Unknown plan operation {}.'.format(op))
+
+        data_columns = []
+        if isinstance(df, pd.DataFrame):
+            data_columns = [c for c in base.data_columns if c in df.columns]
+        return df, data_columns
+
+    def wait(self):
+        """
+        Blocks until the task that produces this node has finished, if it was
+        submitted by an :data:`asynchronous` cell.
+
+        :raises WorkerError: If the task failed.
+        """
+        with _pending_lock:
+            pid, future = _pending.get((self.file, self.node), (None, None))
+        if future is not None and pid == os.getpid():
+            future.result()
+
+    def cancel(self):
+        """
+        Stops the task that produces this node. See :func:`cancel`.
+        """
+        return cancel(self.file, self.node)
+
+    @property
+    def done(self):
+        """
+        Whether the node is ready to be read without waiting.
+        """
+        if self.plan:
+            return False
+        with _pending_lock:
+            pid, future = _pending.get((self.file, self.node), (None, None))
+        return future is None or pid != os.getpid() or future.done()
+
+    @property
+    def in_memory(self):
+        """
+        Whether the frame is held in :data:`results`.
+        """
+        if self.plan:
+            return self.materialize().in_memory
+        self.wait()
+        return (self.file, self.node) in results
+
+    def flush(self):
+        """
+        Writes a frame held in memory to the data store.
+        """
+        if self.plan:
+            return self.materialize().flush()
+        self.wait()
+        results.flush(self.file, self.node)
 
     @property
     def store(self):
@@ -269,15 +1554,35 @@ class H5(object):
         .. warning:: This is not thread-safe. Do not attempt to access from
                      multiple threads without a locking mechanism.
         """
-        return pd.get_store(os.path.join(plugin_cache, self.file), mode='r')
+        if self.plan:
+            return self.materialize().store
+        self.wait()
+        self.flush()
+        return pd.HDFStore(os.path.join(plugin_cache, self.file), mode='r')
 
     @property
     def df(self):
         """
         The dataframe.
+
+        Frames read from the data store are kept in :data:`frame_cache`, so
+        repeated access does not read the store again.
+
+        .. warning:: A frame served from memory is shared with other readers.
+                     Copy it before modifying it in place.
         """
-        df = pd.read_hdf(os.path.join(plugin_cache, self.file),
-                         key=self.node)
+        if self.plan:
+            return self.materialize().df
+        self.wait()
+        df = results.get(self.file, self.node)
+        if df is None:
+            df = frame_cache.get(self.file, self.node)
+        if df is None:
+            df = pd.read_hdf(os.path.join(plugin_cache, self.file),
+                             key=self.node)
+            profiler.add('bytes_in', _nbytes(df))
+            frame_cache.put(self.file, self.node, df)
+        cache.touch(self.file)
         return df
 
     @property
@@ -285,8 +1590,19 @@ class H5(object):
         """
         Provides a column index iterable.
         """
-        cols = pd.read_hdf(os.path.join(plugin_cache, self.file),
-                           start=0, stop=1).columns
+        if self.plan:
+            return self.materialize().columns
+        self.wait()
+        df = results.get(self.file, self.node)
+        if df is None:
+            df = frame_cache.get(self.file, self.node)
+        if df is not None:
+            return df.columns
+        cols = frame_cache.get(self.file, self.node, 'columns')
+        if cols is None:
+            cols = pd.read_hdf(os.path.join(plugin_cache, self.file),
+                               key=self.node, start=0, stop=1).columns
+            frame_cache.put(self.file, self.node, cols, 'columns')
         return cols
 
     @property
@@ -294,23 +1610,70 @@ class H5(object):
         """
         Provides an iterable of columns that are indexed as data.
         """
-        with self.store as store:
-            storer = store.get_storer(self.node)
-            dc = storer.data_columns
+        if self.plan:
+            return self.materialize().data_columns
+        self.wait()
+        df = results.get(self.file, self.node)
+        if df is not None:
+            if isinstance(df, pd.Series):
+                columns = [df.name]
+            else:
+                columns = list(df.columns)
+            dc = results.options(self.file, self.node).get('data_columns')
+            if dc is True:
+                return columns
+            # the options may come from an input with more columns
+            return [c for c in dc or [] if c in columns]
+        dc = frame_cache.get(self.file, self.node, 'data_columns')
+        if dc is None:
+            with pd.HDFStore(os.path.join(plugin_cache, self.file),
+                             mode='r') as store:
+                storer = store.get_storer(self.node)
+                dc = getattr(storer, 'data_columns', [])
+            frame_cache.put(self.file, self.node, dc, 'data_columns')
         return dc
 
+    @property
+    def is_table(self):
+        """
+        Whether the node is stored as a table, which can be queried. A frame
+        held in :data:`results` is not, and is not written to find out.
+        """
+        if self.plan:
+            return self.materialize().is_table
+        self.wait()
+        if (self.file, self.node) in results:
+            return False
+        table = frame_cache.get(self.file, self.node, 'is_table')
+        if table is None:
+            with pd.HDFStore(os.path.join(plugin_cache, self.file),
+                             mode='r') as store:
+                storer = store.get_storer(self.node)
+                table = getattr(storer, 'is_table', False)
+            frame_cache.put(self.file, self.node, table, 'is_table')
+        return table
+
     def select(self, *args, **kwargs):
         """
         Executes a select operation on the hdf5 object.
         """
+        if self.plan:
+            return self.materialize().select(*args, **kwargs)
+        self.wait()
+        self.flush()
         sel = pd.read_hdf(os.path.join(plugin_cache, self.file),
                           *args, key=self.node, **kwargs)
+        profiler.add('bytes_in', _nbytes(sel))
+        cache.touch(self.file)
         return sel
 
     def select_column(self, *args, **kwargs):
         """
         Grabs a series from the store.
         """
+        if self.plan:
+            return self.materialize().select_column(*args, **kwargs)
+        self.wait()
         with self.store as store:
             col = store.select_column(self.node, *args, **kwargs)
         return col
@@ -423,14 +1786,41 @@ class Read_CSV(Custom):
                          should be a dict of fieldnames for keys and integers
                          for their respective sizes. ex: {'A':10, 'B':100}
     :type min_itemsize: dict
+    :param usecols: Only read these columns, given by name or position.
+    :type usecols: list
+    :param dtype: Data types of columns, e.g. ``{'a': 'float64'}``. Giving
+                  types up front saves pandas from inferring them and keeps
+                  them consistent between chunks.
+    :type dtype: type or dict
+    :param chunksize: If given, the file is streamed into the store this many
+                      rows at a time instead of being read whole. Peak memory
+                      is then bounded by the chunk size. Supply
+                      ``min_itemsize`` for string columns whose widest value
+                      may not appear in the first chunk.
+    :type chunksize: int
+    :param content_hash: Identify the file by a hash of its contents instead
+                         of its size and modification time when checking for
+                         a previous ingestion.
+    :type content_hash: boolean, default False
     :returns: The parsed csv file.
     :rtype: H5
+
+    .. note:: The parsed file is written with the ``final`` storage policy
+              since it is queried by every downstream cell. Set ``storage``
+              on the cell to change it.
+
+    .. tip:: Local files are only parsed once. The store is named after the
+             file's path, size, modification time and the parse options, and
+             is reused while none of them change.
     """
     infer_datetime_format = {'True': 'True', 'False': 'False'}
     inputs = {'csv': None, 'index_col': None, 'parse_dates': None,
-              'infer_datetime_format': {}, 'data_columns': []}
+              'infer_datetime_format': {}, 'data_columns': [],
+              'min_itemsize': None, 'usecols': None, 'dtype': None,
+              'chunksize': None, 'content_hash': False}
     outputs = {'dataframe': None}
     required = ['csv']
+    storage = 'final'
 
     def __init__(self):
         super().__init__()
@@ -446,27 +1836,150 @@ class Read_CSV(Custom):
         if not self.inputs['infer_datetime_format'] == '':
             kwargs['infer_datetime_format'] = (
                                 self.inputs['infer_datetime_format'])
+        for k in ('usecols', 'dtype'):
+            if self.inputs[k] is not None:
+                kwargs[k] = self.inputs[k]
 
         dfkwargs = {}
         if self.inputs['data_columns'] is not None:
             dfkwargs['data_columns'] = self.inputs['data_columns']
+        if self.inputs['min_itemsize'] is not None:
+            dfkwargs['min_itemsize'] = self.inputs['min_itemsize']
 
         node = os.path.splitext(os.path.basename(self.inputs['csv']))[0]
         file = '{}.h5'.format(node)
+        chunksize = self.inputs['chunksize']
 
-        def read_file(file, node, dfkwargs, **kwargs):
-            df = pd.read_csv(self.inputs['csv'], **kwargs)
-            if 'data_columns' in dfkwargs.keys():
-                if not isinstance(dfkwargs['data_columns'], bool):
-                    df.set_index(dfkwargs['data_columns'])
-            H5(file, node, df, **dfkwargs)
+        digest = self.ingest_key(kwargs, dfkwargs)
+        if digest is not None:
+            file = '{}_{}.h5'.format(node, digest[:16])
+            if Read_CSV.ingested(file, node, digest):
+                cache.touch(file)
+                self.return_msg_ = 'Reusing {}.'.format(file)
+                return H5(file, node)
 
-        largs = (file, node, dfkwargs)
+        def read_file(conn, file, node, dfkwargs, **kwargs):
+            try:
+                if chunksize:
+                    chunks = pd.read_csv(self.inputs['csv'],
+                                         chunksize=chunksize, **kwargs)
+                    rows = H5.write_chunks(chunks, file, node,
+                                           storage=self.storage,
+                                           progress=conn.send, **dfkwargs)
+                else:
+                    df = pd.read_csv(self.inputs['csv'], **kwargs)
+                    if 'data_columns' in dfkwargs.keys():
+                        if not isinstance(dfkwargs['data_columns'], bool):
+                            df.set_index(dfkwargs['data_columns'])
+                    H5(file, node, df, storage=self.storage, **dfkwargs)
+                    rows = len(df)
+                if digest is not None:
+                    with pd.HDFStore(os.path.join(plugin_cache, file)) as s:
+                        s.get_storer(node).attrs.ingest_key = digest
+                conn.send(('done', rows))
+            except Exception:
+                conn.send(('error', ''.join(traceback.format_exception(
+                                            *sys.exc_info()))))
+
+        results.discard(file, node)
+        parent_conn, child_conn = Pipe()
+        largs = (child_conn, file, node, dfkwargs)
         p = Process(target=read_file, args=largs, kwargs=kwargs)
         p.start()
-        p.join()
-        h5 = H5(file, node)
-        return h5
+        child_conn.close()
+        with _pending_lock:
+            _readers[(file, node)] = p
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        status = None
+        try:
+            while status is None:
+                remaining = None
+                if deadline is not None:
+                    remaining = max(deadline - time.monotonic(), 0)
+                if not parent_conn.poll(remaining):
+                    p.terminate()
+                    status = ('error', 'Timed out. Reading {} exceeded {} '
+                              'seconds.'.format(file, self.timeout))
+                    break
+                try:
+                    msg = parent_conn.recv()
+                except EOFError:
+                    p.join()
+                    status = ('error', 'Failed. Reader exited with code '
+                              '{}.'.format(p.exitcode))
+                    break
+                if isinstance(msg, tuple):
+                    status = msg
+                else:
+                    self.return_msg_ = 'Read {} rows...'.format(msg)
+        finally:
+            with _pending_lock:
+                _readers.pop((file, node), None)
+            p.join()
+            parent_conn.close()
+        frame_cache.invalidate(file, node)
+
+        if status[0] == 'error':
+            print(status[1])
+            _cleanup(file, node)
+            msg = status[1].strip().splitlines()[-1]
+            if msg.startswith('Timed out'):
+                pass
+            elif p.exitcode == -signal.SIGTERM:
+                # terminated by cancel(), which leaves the pipe closed
+                msg = 'Cancelled.'
+            elif not msg.startswith('Failed'):
+                msg = 'Failed. {}'.format(msg)
+            self.fail(msg)
+            self.return_msg_ = 'Could not read {}.'.format(self.inputs['csv'])
+            return None
+        cache.written(file)
+        self.return_msg_ = 'Read {} rows.'.format(status[1])
+        return H5(file, node)
+
+    def ingest_key(self, kwargs, dfkwargs):
+        """
+        Identifies an ingestion by the csv file and the options used to parse
+        and store it.
+
+        :returns: A hex digest, or ``None`` if the csv is not a local file.
+        :rtype: str
+        """
+        csv = self.inputs['csv']
+        try:
+            st = os.stat(csv)
+        except (OSError, TypeError, ValueError):
+            return None
+        if self.inputs['content_hash']:
+            h = hashlib.sha1()
+            with open(csv, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    h.update(block)
+            ident = h.hexdigest()
+        else:
+            ident = st.st_mtime_ns
+        key = (os.path.abspath(csv), st.st_size, ident,
+               sorted(kwargs.items()), sorted(dfkwargs.items()),
+               self.storage)
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    @staticmethod
+    def ingested(file, node, digest):
+        """
+        Whether ``node`` of ``file`` holds a complete ingestion tagged with
+        ``digest``.
+        """
+        path = os.path.join(plugin_cache, file)
+        if not os.path.exists(path):
+            return False
+        try:
+            with pd.HDFStore(path, mode='r') as store:
+                attrs = store.get_storer(node).attrs
+                return getattr(attrs, 'ingest_key', None) == digest
+        except Exception:
+            return False
 
     def process(self):
         self.outputs['dataframe'] = self.read_csv()
@@ -488,6 +2001,7 @@ class Iloc(Custom):
     """
     inputs = {'axis0': None, 'axis1': None, 'data': None}
     outputs = {'dataframe': None}
+    threadsafe = True
     required = ['data']
 
     def __init__(self):
@@ -523,6 +2037,7 @@ class Loc(Custom):
     """
     inputs = {'axis0': None, 'axis1': None, 'data': None}
     outputs = {'dataframe': None}
+    threadsafe = True
     required = ['data']
 
     def __init__(self):
@@ -557,6 +2072,7 @@ class Head(Custom):
     required = ['data']
     inputs = ValidInputs(n=5, data=None)
     outputs = {'dataframe': None}
+    threadsafe = True
 
 
     def __init__(self):
@@ -576,7 +2092,12 @@ class Head(Custom):
         return True
 
     def process(self):
-        self.outputs['dataframe'] = self.head(self.inputs['data'].value)
+        h5 = self.inputs['data'].value
+        if lazy and isinstance(h5, H5):
+            self.outputs['dataframe'] = h5.defer('head',
+                                                 self.inputs['n'].value)
+        else:
+            self.outputs['dataframe'] = self.head(h5)
         return super().process()
 
 
@@ -593,6 +2114,7 @@ class Tail(Custom):
     """
     inputs = ValidInputs({'n': 5, 'data': None})
     outputs = {'dataframe': None}
+    threadsafe = True
     required = ['data']
 
     def __init__(self):
@@ -612,7 +2134,12 @@ class Tail(Custom):
         return True
 
     def process(self):
-        self.outputs['dataframe'] = self.tail(self.inputs['data'].value)
+        h5 = self.inputs['data'].value
+        if lazy and isinstance(h5, H5):
+            self.outputs['dataframe'] = h5.defer('tail',
+                                                 self.inputs['n'].value)
+        else:
+            self.outputs['dataframe'] = self.tail(h5)
         return super().process()
 
 
@@ -639,14 +2166,19 @@ class Sort_Values(Custom):
 
     @data_process
     def sort_values(self, h5):
-        if not isinstance(h5.df, pd.Series):
-            df = h5.df.sort_values(self.inputs['column_list'])
+        df = h5.df
+        if not isinstance(df, pd.Series):
+            df = df.sort_values(self.inputs['column_list'])
         else:
-            df = h5.df.sort_values()
+            df = df.sort_values()
         return df
 
     def process(self):
-        self.outputs['data'] = self.sort_values()
+        h5 = self.inputs['data']
+        if lazy and isinstance(h5, H5):
+            self.outputs['data'] = h5.defer('sort', self.inputs['column_list'])
+        else:
+            self.outputs['data'] = self.sort_values(h5)
         self.return_msg_ = 'Sorted'
         return super().process()
 
@@ -671,6 +2203,7 @@ class Column(Custom):
     required = ['data', 'columns']
     inputs = {'data': None, 'columns': []}
     outputs = {'data': None}
+    threadsafe = True
 
     def __init__(self):
         super().__init__()
@@ -679,6 +2212,9 @@ class Column(Custom):
     @data_process
     def column(self, h5):
         cols = self.inputs['columns']
+        if h5.in_memory:
+            # selecting from the store would flush the frame to it
+            return h5.df[cols]
         try:
             if not isinstance(cols, list):
                 df = h5.select_column(column=cols)
@@ -690,7 +2226,18 @@ class Column(Custom):
 
     def process(self):
         self.return_msg_ = 'Selecting column...'
-        self.outputs['data'] = self.column(self.inputs['data'])
+        h5 = self.inputs['data']
+        cols = self.inputs['columns']
+        if lazy and isinstance(h5, H5):
+            self.outputs['data'] = h5.defer('columns', cols)
+        else:
+            self.outputs['data'] = self.column(h5)
+        out = self.outputs['data']
+        if (isinstance(cols, str) and isinstance(out, H5) and
+                isinstance(h5, H5) and not h5.plan):
+            # remember where the series came from so that comparisons on it
+            # can be pushed down into the store
+            out.source = (h5.file, h5.node, cols)
         self.return_msg_ = 'Selected'
         return super().process(QuReturnCode('OK'))
 
@@ -707,6 +2254,7 @@ class IsNull(Custom):
     required = ['series']
     inputs = {'series': None}
     outputs = {'series': None}
+    threadsafe = True
 
     def __init__(self):
         super().__init__()
@@ -734,6 +2282,7 @@ class NotNull(Custom):
     required = ['series']
     inputs = {'series': None}
     outputs = {'series': None}
+    threadsafe = True
 
     def __init__(self):
         super().__init__()
@@ -761,19 +2310,39 @@ class Select(Custom):
     :type expression: string
     :returns: A subset of data.
     :rtype: H5
+
+    .. tip:: If the sieve compares a data column of ``data`` with a scalar,
+             for example ``Column`` followed by ``Gt``, the comparison is run
+             by the data store and only the matching rows are read.
     """
     required = ['data']
     inputs = {'data': None, 'sieve': None, 'expression': ''}
     outputs = {'dataframe': None}
+    threadsafe = True
 
     def __init__(self):
         super().__init__()
         self.return_msg_ = 'Ready to select.'
 
 
+    def pushdown(self, h5):
+        """
+        Returns the sieve's ``where`` condition if it can be evaluated by the
+        store that holds ``h5``.
+        """
+        sieve = self.inputs['sieve']
+        if (isinstance(h5, H5) and isinstance(sieve, H5) and
+                sieve.condition is not None and
+                (sieve.file, sieve.node) == (h5.file, h5.node)):
+            return sieve.condition
+        return None
+
     @data_process
     def select(self, h5):
-        if self.is_valid_input(self.inputs['sieve']):
+        condition = None if h5.plan else self.pushdown(h5)
+        if condition is not None:
+            return h5.select(where=condition)
+        elif self.is_valid_input(self.inputs['sieve']):
             s = self.inputs['sieve'].df
             return h5.df[s]
         elif self.is_valid_input(self.inputs['expression']):
@@ -782,7 +2351,18 @@ class Select(Custom):
             return h5.df
 
     def process(self):
-        self.outputs['dataframe'] = self.select(self.inputs['data'])
+        h5 = self.inputs['data']
+        condition = self.pushdown(h5)
+        if (lazy and condition is not None and
+                all(step[0] in ('columns', 'where') for step in h5.plan)):
+            self.outputs['dataframe'] = h5.defer('where', condition)
+        elif (lazy and isinstance(h5, H5) and
+                not self.is_valid_input(self.inputs['sieve']) and
+                self.is_valid_input(self.inputs['expression'])):
+            self.outputs['dataframe'] = h5.defer('where',
+                                                 self.inputs['expression'])
+        else:
+            self.outputs['dataframe'] = self.select(h5)
         self.return_msg_ = 'Data is filtered.'
         return super().process()
 
@@ -941,14 +2521,22 @@ class GroupBy(Custom):
                     also be an expression operating on a Series. For multiple
                     columns a list is required.
     :type columns: string
-    :param aggregation: The method used to summarize groups.
-    :type aggregation: string
+    :param aggregation: The method used to summarize groups. A dict maps
+                        column names to a method or list of methods.
+    :type aggregation: string or dict
+    :param partitions: Number of row ranges to aggregate in parallel on the
+                       worker pool. Partial results are combined into the same
+                       result as a single pass. Only used when ``columns``
+                       names stored columns of a table.
+    :type partitions: int
     :returns: Grouped data.
     :rtype: H5
     """
-    aggregation = {'size': 'size', 'min': 'min', 'mean': 'mean', 'max': 'max'}
+    aggregation = {'size': 'size', 'min': 'min', 'mean': 'mean', 'max': 'max',
+                   'sum': 'sum', 'count': 'count', 'std': 'std'}
     required = ['dataframe', 'columns']
-    inputs = {'dataframe': None, 'columns': None, 'aggregation': {}}
+    inputs = {'dataframe': None, 'columns': None, 'aggregation': {},
+              'partitions': 1}
     outputs = {'data': None}
 
     def __init__(self):
@@ -962,23 +2550,172 @@ class GroupBy(Custom):
     def stop(self):
         self.return_msg_ = 'Finished process.'
 
-    @data_process
-    def groupby(self, h5):
+    statistics = {'size': ['size'], 'count': ['count'], 'sum': ['sum'],
+                  'min': ['min'], 'max': ['max'], 'mean': ['sum', 'count'],
+                  'std': ['count', 'mean', 'm2']}
+    """The partial statistics each method is combined from."""
+
+    @staticmethod
+    def aggregate(df, columns, method):
+        """
+        Groups ``df`` by ``columns`` and summarizes each group with
+        ``method``.
+        """
+        groups = df.groupby(columns)
+        if isinstance(method, dict):
+            return groups.agg(method)
+        elif method in GroupBy.aggregation and method != 'size':
+            return getattr(groups, method)()
+        else:
+            return groups.size()
+
+    @staticmethod
+    def needs(method):
+        """
+        Returns the partial statistics needed for ``method`` as a dict of
+        statistic to a list of columns, or ``None`` for all columns.
+        """
+        if not isinstance(method, dict):
+            method = method if method in GroupBy.statistics else 'size'
+            return {stat: None for stat in GroupBy.statistics[method]}
+        needs = {}
+        for column, methods in method.items():
+            if not isinstance(methods, list):
+                methods = [methods]
+            for m in methods:
+                for stat in GroupBy.statistics[m]:
+                    needs.setdefault(stat, [])
+                    if column not in needs[stat]:
+                        needs[stat].append(column)
+        return needs
+
+    @staticmethod
+    def partials(df, columns, needs):
+        """
+        Computes the partial statistics in ``needs`` for one partition of the
+        rows.
+        """
+        groups = df.groupby(columns)
+        parts = {}
+        for stat, cols in needs.items():
+            if stat == 'size':
+                parts[stat] = groups.size()
+                continue
+            g = groups if cols is None else groups[cols]
+            if stat == 'm2':
+                parts[stat] = g.var(ddof=0) * g.count()
+            else:
+                parts[stat] = getattr(g, stat)()
+        return parts
+
+    @staticmethod
+    def combine(parts, method):
+        """
+        Combines the partial statistics of each partition into the result of
+        :meth:`aggregate` for ``method``.
+        """
+        def total(stat, how):
+            df = pd.concat([p[stat] for p in parts])
+            return getattr(df.groupby(level=list(range(df.index.nlevels))),
+                           how)()
+
+        def final(m, cols=None):
+            pick = (lambda df: df) if cols is None else (lambda df: df[cols])
+            if m == 'size':
+                return total('size', 'sum')
+            elif m in ('count', 'sum'):
+                return pick(total(m, 'sum'))
+            elif m in ('min', 'max'):
+                return pick(total(m, m))
+            elif m == 'mean':
+                return pick(total('sum', 'sum')) / pick(total('count', 'sum'))
+            # std from the count, mean and sum of squared deviations of each
+            # partition
+            n = pick(total('count', 'sum'))
+            weighted = pd.concat([(pick(p['count']) * pick(p['mean'])).fillna(0)
+                                  for p in parts])
+            mean = weighted.groupby(level=list(range(
+                weighted.index.nlevels))).sum() / n
+            m2 = pd.concat([
+                (pick(p['m2']) + pick(p['count']) *
+                 (pick(p['mean']) - mean.reindex(p['mean'].index)) ** 2
+                 ).fillna(0) for p in parts])
+            m2 = m2.groupby(level=list(range(m2.index.nlevels))).sum()
+            return np.sqrt(m2 / (n - 1))
+
+        if not isinstance(method, dict):
+            return final(method if method in GroupBy.statistics else 'size')
+        flat = all(not isinstance(m, list) for m in method.values())
+        out = OrderedDict()
+        for column, methods in method.items():
+            if flat:
+                out[column] = final(methods, [column])[column]
+                continue
+            for m in methods if isinstance(methods, list) else [methods]:
+                out[(column, m)] = final(m, [column])[column]
+        return pd.concat(out, axis=1)
+
+    def partitioned(self, h5):
+        """
+        Aggregates ``h5`` in ``partitions`` row ranges on the worker pool,
+        or returns ``None`` if it cannot be partitioned.
+        """
+        columns = self.inputs['columns']
+        partitions = self.inputs['partitions']
+        if not isinstance(columns, list):
+            columns = [columns]
+        if (not isinstance(partitions, int) or partitions < 2 or
+                not isinstance(h5, H5) or h5.plan or h5.in_memory or
+                not all(isinstance(c, str) for c in columns)):
+            return None
+        with h5.store as store:
+            storer = store.get_storer(h5.node)
+            if not getattr(storer, 'is_table', False):
+                return None
+            nrows = storer.nrows
+        columns = self.inputs['columns']
+        method = self.method()
+        needs = GroupBy.needs(method)
+        bounds = np.linspace(0, nrows, partitions + 1).astype(int)
+        tasks = [(h5.file, h5.node, int(start), int(stop), columns, needs)
+                 for start, stop in zip(bounds[:-1], bounds[1:])]
+        file = '{}.h5'.format(self.py_id)
+        node = 'c{}'.format(self.py_id)
+        self.return_msg_ = 'Grouping {} partitions...'.format(len(tasks))
+        parts = pool.map(_run_partial_groupby, tasks, timeout=self.timeout,
+                         tag=(file, node))
+        results.put(file, node, GroupBy.combine(parts, method))
+        return H5(file, node)
+
+    def method(self):
         method = 'size'  # set the default
         if self.inputs['aggregation'] != GroupBy.aggregation:
             method = self.inputs['aggregation']
+        return method
 
-        if method == 'min':
-            return h5.df.groupby(self.inputs['columns']).min()
-        elif method == 'mean':
-            return h5.df.groupby(self.inputs['columns']).mean()
-        elif method == 'max':
-            return h5.df.groupby(self.inputs['columns']).max()
-        else:
-            return h5.df.groupby(self.inputs['columns']).size()
+    @data_process
+    def groupby(self, h5):
+        return GroupBy.aggregate(h5.df, self.inputs['columns'], self.method())
 
     def process(self):
-        self.outputs['data'] = self.groupby(self.inputs['dataframe'])
+        h5 = self.inputs['dataframe']
+        if lazy and isinstance(h5, H5):
+            self.outputs['data'] = h5.defer('groupby', self.inputs['columns'],
+                                            self.method())
+        else:
+            try:
+                out = self.partitioned(h5)
+                if out is None:
+                    out = self.groupby(h5)
+            except (TimeoutError, Cancelled) as e:
+                print(e)
+                self.fail(describe(e))
+                out = None
+            except WorkerError as e:
+                print(e)
+                print('Error grouping partitions of {}'.format(h5.file))
+                out = self.groupby(h5)
+            self.outputs['data'] = out
         self.return_msg_ = 'Data is grouped.'
         return super().process()
 
@@ -1253,9 +2990,20 @@ class Merge(Custom):
     :type suffixes: 2-length sequence (tuple, list, ...)
     :param copy: If False, do not copy data unnecessarily
     :type copy: boolean, default True
+    :param buckets: If greater than one, join out of core. Both inputs are
+                    split into this many buckets on disk by a hash of the join
+                    keys, and pairs of buckets are joined in parallel on the
+                    worker pool. Only the result and one pair of buckets per
+                    worker are held in memory. Not used when joining on
+                    indexes.
+    :type buckets: int, default 1
 
     :returns: The merged result.
     :rtype: H5
+
+    .. note:: A bucketed join returns the same rows as an in-memory join, but
+              grouped by bucket. With ``sort``, rows are sorted within each
+              bucket only.
     """
     how = {'left': 'left', 'right': 'right', 'outer': 'outer',
            'inner': 'inner'}
@@ -1263,7 +3011,7 @@ class Merge(Custom):
     inputs = {'A': None, 'B': None, 'how': {}, 'on': None,
               'left_on': None, 'right_on': None, 'left_index': False,
               'right_index': False, 'sort': False, 'suffixes': None,
-              'copy': True}
+              'copy': True, 'buckets': 1}
     outputs = {'dataframe': None}
 
     def __init__(self):
@@ -1271,8 +3019,10 @@ class Merge(Custom):
         self.return_msg_ = 'Ready to merge.'
         self.inputs['how'] = Merge.how
 
-    @data_process
-    def merge(self, h5):
+    def options(self):
+        """
+        Returns the keyword arguments for :meth:`pandas.DataFrame.merge`.
+        """
         kwargs = {}
         if self.is_valid_input(self.inputs['how']):
             kwargs['how'] = self.inputs['how']
@@ -1300,7 +3050,106 @@ class Merge(Custom):
 
         if self.is_valid_input(self.inputs['copy']):
             kwargs['copy'] = self.inputs['copy']
+        return kwargs
+
+    @staticmethod
+    def keys(h5a, h5b, kwargs):
+        """
+        Returns the left and right join columns, or ``None`` if the join is
+        not on columns.
+        """
+        if kwargs.get('left_index') or kwargs.get('right_index'):
+            return None
+        left = kwargs.get('left_on')
+        right = kwargs.get('right_on')
+        if 'on' in kwargs:
+            left = right = kwargs['on']
+        elif left is None and right is None:
+            left = right = [c for c in h5a.columns if c in set(h5b.columns)]
+        keys = []
+        for k in (left, right):
+            k = k if isinstance(k, list) else [k]
+            if not k or not all(isinstance(c, str) for c in k):
+                return None
+            keys.append(k)
+        return keys
+
+    @staticmethod
+    def key_types(h5a, h5b, keys):
+        """
+        Returns the types to hash each pair of join columns as, so equal keys
+        land in the same bucket, or ``None`` if a pair has no common type.
+        """
+        left, right = [pd.read_hdf(os.path.join(plugin_cache, h5.file),
+                                   h5.node, start=0, stop=0).dtypes
+                       for h5 in (h5a, h5b)]
+        dtypes = []
+        for a, b in zip(left[keys[0]], right[keys[1]]):
+            if a == b:
+                dtypes.append(a)
+                continue
+            # hashes of other types, such as objects, depend on the type
+            if a.kind not in 'biuf' or b.kind not in 'biuf':
+                return None
+            try:
+                dtypes.append(np.result_type(a, b))
+            except TypeError:
+                return None
+        return dtypes
 
+    def bucketed(self, h5):
+        """
+        Joins ``A`` and ``B`` through on-disk buckets on the worker pool, or
+        returns ``None`` if the join cannot be bucketed.
+        """
+        buckets = self.inputs['buckets']
+        h5b = self.inputs['B']
+        if (not isinstance(buckets, int) or buckets < 2 or
+                not isinstance(h5, H5) or not isinstance(h5b, H5)):
+            return None
+        kwargs = self.options()
+        keys = Merge.keys(h5, h5b, kwargs)
+        if keys is None:
+            return None
+        h5, h5b = h5.materialize(), h5b.materialize()
+        h5.flush()
+        h5b.flush()
+        dtypes = Merge.key_types(h5, h5b, keys)
+        if dtypes is None:
+            return None
+        index = list(set(h5.data_columns) | set(h5b.data_columns))
+
+        file = '{}.h5'.format(self.py_id)
+        node = 'c{}'.format(self.py_id)
+        sides = ['{}_{}.h5'.format(node, side) for side in 'AB']
+        pieces = ['{}_j{}'.format(node, b) for b in range(buckets)]
+        try:
+            self.return_msg_ = 'Splitting into {} buckets...'.format(buckets)
+            pool.map(_run_bucket_task, [
+                (h5.file, h5.node, keys[0], dtypes, buckets, sides[0]),
+                (h5b.file, h5b.node, keys[1], dtypes, buckets, sides[1])],
+                timeout=self.timeout, tag=(file, node))
+            self.return_msg_ = 'Joining {} buckets...'.format(buckets)
+            pool.map(_run_bucket_join, [
+                (sides[0], sides[1], b, kwargs, index, file, piece)
+                for b, piece in enumerate(pieces)],
+                timeout=self.timeout, tag=(file, node))
+            df = pd.concat([load_frame(frame_path(file, piece))[0]
+                            for piece in pieces])
+        finally:
+            for side in sides:
+                try:
+                    os.remove(os.path.join(plugin_cache, side))
+                except OSError:
+                    pass
+            for piece in pieces:
+                shutil.rmtree(frame_path(file, piece), ignore_errors=True)
+        results.put(file, node, df, data_columns=h5.data_columns)
+        return H5(file, node)
+
+    @data_process
+    def merge(self, h5):
+        kwargs = self.options()
         h5b = self.inputs['B']
         assert isinstance(h5b, H5), 'Socket B must be an H5 type.'
 
@@ -1318,7 +3167,19 @@ class Merge(Custom):
         return df
 
     def process(self):
-        self.outputs['dataframe'] = self.merge(self.inputs['A'])
+        try:
+            out = self.bucketed(self.inputs['A'])
+            if out is None:
+                out = self.merge(self.inputs['A'])
+        except (TimeoutError, Cancelled) as e:
+            print(e)
+            self.fail(describe(e))
+            out = None
+        except WorkerError as e:
+            print(e)
+            print('Error joining buckets')
+            out = self.merge(self.inputs['A'])
+        self.outputs['dataframe'] = out
         self.return_msg_ = 'I have merged!'
         return super().process()
 
@@ -1402,14 +3263,15 @@ class Update(Custom):
     def update(self, h5):
         assert isinstance(self.inputs['data'], H5), \
             "dataframe must be an H5."
-        df = h5.df
+        # the cached frame is shared, so update a copy
+        df = h5.df.copy()
+        values = self.inputs['values'].df
         if self.inputs['rows'] == '':
-            df.loc[:, self.inputs['column']] = self.inputs['values'].df
+            df.loc[:, self.inputs['column']] = values
         else:
-            assert isinstance(self.inputs['rows'].df, pd.Series), \
-                "rows must be a Series."
-            df.loc[self.inputs['rows'].df, self.inputs['column']] = \
-                self.inputs['values'].df
+            rows = self.inputs['rows'].df
+            assert isinstance(rows, pd.Series), "rows must be a Series."
+            df.loc[rows, self.inputs['column']] = values
         return df
 
     def process(self):
@@ -3,13 +3,25 @@ Projection
 ==========
 The projection module produces tensors that are intended to represent your
 model's time series results.
+
+Cells that are given the ``tensor`` input write their results to
+memory-mapped ``.npy`` files in the data store and output a :class:`Tensor`
+handle instead of an array, so results larger than memory can flow through a
+circuit.
 """
 
 from PyCell.custom_cell import Custom
+from PyCell.dataframe_cell import H5, results, cache, plugin_cache
+from PyCell.worker_pool import pool, WorkerError, Cancelled, describe
 from PyCell import registry
 import ast
+import functools
+import numbers
 import operator as op
+import os
+import weakref
 import numpy as np
+import pandas as pd
 
 registry += [
     {
@@ -22,14 +34,428 @@ registry += [
     'module': 'PyCell.projection_cell',
     'categories': ['Math', 'Numeric']
     },
+    {
+    'name': 'Projection',
+    'module': 'PyCell.projection_cell',
+    'categories': ['Math', 'Numeric']
+    },
+    {
+    'name': 'Recurrence',
+    'module': 'PyCell.projection_cell',
+    'categories': ['Math', 'Numeric']
+    },
     ]
 
+def _power(a, b):
+    """
+    *Internal*. Raises ``a`` to the power ``b``. NumPy refuses negative
+    integer powers of integers, so those are taken in floating point as Python
+    would. NumPy integer powers that overflow are taken in floating point too,
+    where Python would return a larger integer.
+    """
+    try:
+        result = op.pow(a, b)
+    except ValueError:
+        return op.pow(np.asarray(a, dtype=float), b)
+    if (isinstance(result, (np.ndarray, np.integer)) and
+            result.dtype.kind in 'iu'):
+        with np.errstate(over='ignore'):
+            exact = op.pow(np.asarray(a, dtype=float), b)
+        if np.any(np.abs(exact) > np.iinfo(result.dtype).max):
+            return exact
+    return result
+
+
 # supported operators
 operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul,
-             ast.Div: op.truediv, ast.Pow: op.pow, ast.BitXor: op.xor,
+             ast.Div: op.truediv, ast.Pow: _power, ast.BitXor: op.xor,
              ast.USub: op.neg}
 
 
+def _number(node):
+    """
+    *Internal*. Returns the value of a numeric literal, or ``None`` if
+    ``node`` is not one.
+    """
+    if isinstance(node, ast.Constant):  # Python 3.8+
+        value = node.value
+    elif isinstance(node, ast.Num):
+        value = node.n
+    else:
+        return None
+    if isinstance(value, bool) or not isinstance(value, numbers.Number):
+        return None
+    return value
+
+
+class AstExpression(object):
+    """
+    A math expression that is parsed and validated once, then evaluated over
+    whole vectors. Only numbers, the variables in ``names`` and the operators
+    in ``operators`` are allowed.
+
+    Example::
+
+        >>> f = AstExpression('1 + 2*t**2')
+        >>> f(t=np.array([1, 2, 3]))
+        array([ 3,  9, 19])
+
+    :param expr: The expression.
+    :type expr: str
+    :param names: The variables the expression may refer to.
+    :type names: tuple
+    :raises TypeError: If the expression uses anything else.
+    """
+    def __init__(self, expr, names=('t',)):
+        self.expr = expr
+        self.names = tuple(names)
+        self._func = self._compile(ast.parse(expr, mode='eval').body)
+
+    def __call__(self, **values):
+        return self._func(values)
+
+    def _compile(self, node):
+        """
+        *Internal*. Turns a syntax tree into nested closures, so evaluating
+        the expression does not walk the tree again.
+        """
+        value = _number(node)
+        if value is not None:  # <number>
+            return lambda values: value
+        elif isinstance(node, ast.Name) and node.id in self.names:  # <name>
+            name = node.id
+            return lambda values: values[name]
+        elif (isinstance(node, ast.BinOp) and
+              type(node.op) in operators):  # <left> <operator> <right>
+            func = operators[type(node.op)]
+            left = self._compile(node.left)
+            right = self._compile(node.right)
+            return lambda values: func(left(values), right(values))
+        elif (isinstance(node, ast.UnaryOp) and
+              type(node.op) in operators):  # <operator> <operand> e.g., -1
+            func = operators[type(node.op)]
+            operand = self._compile(node.operand)
+            return lambda values: func(operand(values))
+        else:
+            raise TypeError('Unsupported expression {!r}: {}'.format(
+                            self.expr, ast.dump(node)))
+
+
+# NumPy functions and constants available to NumpyColumn expressions, both
+# bare and as attributes of np
+functions = {name: getattr(np, name) for name in (
+    'abs', 'ceil', 'clip', 'cos', 'cumprod', 'cumsum', 'exp', 'expm1',
+    'floor', 'log', 'log10', 'log1p', 'maximum', 'minimum', 'power', 'round',
+    'sign', 'sin', 'sqrt', 'tan', 'where')}
+constants = {'pi': np.pi, 'e': np.e, 'inf': np.inf, 'nan': np.nan}
+
+max_exponent = 1024
+"""
+The largest literal exponent or shift allowed in NumpyColumn expressions.
+Python evaluates powers of literal integers exactly, so an expression such as
+``10**10**8`` would never finish.
+"""
+
+# syntax allowed in NumpyColumn expressions besides names and calls
+_numpy_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare,
+                ast.Load, ast.operator, ast.unaryop, ast.cmpop,
+                ast.keyword)
+
+
+class NumpyExpression(object):
+    """
+    A NumPy expression that has been validated and compiled. It may use
+    numbers, arithmetic, bitwise and comparison operators, the ``functions``
+    and ``constants`` of this module (bare or as ``np.<name>``), and
+    variables. Anything else, such as other attributes, subscripts, lambdas
+    or builtins, is rejected. Use :func:`compile_expression` to share
+    compiled expressions.
+
+    Example::
+
+        >>> f = NumpyExpression('np.exp(-r*t)')
+        >>> sorted(f.names)
+        ['r', 't']
+        >>> f(t=np.arange(3), r=0.0)
+        array([1., 1., 1.])
+
+    :param expr: The expression.
+    :type expr: str
+    :raises TypeError: If the expression uses anything not allowed.
+    """
+    def __init__(self, expr):
+        self.expr = expr
+        tree = ast.parse(expr, mode='eval')
+        self.names = set()
+        """The variables the expression refers to."""
+        self._validate(tree)
+        self._code = compile(tree, '<{}>'.format(expr), 'eval')
+
+    def __call__(self, **values):
+        namespace = dict(constants, **functions)
+        namespace.update(np=_numpy, __builtins__={})
+        return eval(self._code, namespace, values)
+
+    def _reject(self, node):
+        raise TypeError('Unsupported expression {!r}: {}'.format(
+                        self.expr, ast.dump(node)))
+
+    def _validate(self, node):
+        """
+        *Internal*. Checks every node of ``node`` and records the variables.
+        """
+        if _number(node) is not None:
+            return
+        elif isinstance(node, ast.Name):
+            if node.id.startswith('_') or node.id == 'np':
+                self._reject(node)
+            if node.id not in functions and node.id not in constants:
+                self.names.add(node.id)
+            return
+        elif isinstance(node, ast.Attribute):
+            if not (isinstance(node.value, ast.Name) and
+                    node.value.id == 'np' and
+                    (node.attr in functions or node.attr in constants)):
+                self._reject(node)
+            return
+        elif isinstance(node, ast.Call):
+            if not (isinstance(node.func, ast.Name) and
+                    node.func.id in functions or
+                    isinstance(node.func, ast.Attribute)):
+                self._reject(node)
+            if any(isinstance(a, ast.Starred) for a in node.args):
+                self._reject(node)
+            if any(k.arg is None for k in node.keywords):
+                self._reject(node)
+        elif not isinstance(node, _numpy_nodes):
+            self._reject(node)
+        elif (isinstance(node, ast.BinOp) and
+              isinstance(node.op, (ast.Pow, ast.LShift))):
+            self._check_exponent(node.right)
+        for child in ast.iter_child_nodes(node):
+            self._validate(child)
+
+    def _check_exponent(self, node):
+        """
+        *Internal*. Rejects an exponent made only of literals that is larger
+        than :data:`max_exponent` or is itself a power. Exponents that use
+        variables are evaluated by NumPy at a fixed precision.
+        """
+        nodes = list(ast.walk(node))
+        if any(isinstance(n, (ast.Name, ast.Attribute, ast.Call))
+               for n in nodes):
+            return
+        for n in nodes:
+            value = _number(n)
+            if ((value is not None and abs(value) > max_exponent) or
+                    (isinstance(n, ast.BinOp) and
+                     isinstance(n.op, (ast.Pow, ast.LShift)))):
+                raise TypeError('Exponent too large in {!r}: {}'.format(
+                                self.expr, ast.dump(node)))
+
+
+class _Namespace(object):
+    """
+    *Internal*. Stands in for ``np`` in compiled expressions.
+    """
+    def __init__(self, attrs):
+        self.__dict__.update(attrs)
+
+
+_numpy = _Namespace(dict(constants, **functions))
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_expression(expr):
+    """
+    Returns the :class:`NumpyExpression` for ``expr``. Compiled expressions
+    are cached by their text and shared by every cell.
+
+    :raises TypeError: If the expression uses anything not allowed.
+    """
+    return NumpyExpression(expr)
+
+
+class Tensor(object):
+    """
+    Proxy for an array held in a ``.npy`` file in the data store. Used in
+    place of the array between cell sockets: only the file name is pickled,
+    and the data is memory-mapped when it is read, so only the parts that are
+    used are loaded.
+
+    Example::
+
+        >>> t = Tensor.create('example.npy', (3, 2))
+        >>> t.open('r+')[:] = 1
+        >>> t.shape
+        (3, 2)
+        >>> t.view(0, 1)[:, 0]
+        memmap([1., 1., 1.])
+
+    :param file: The name of the file in the data store.
+    :type file: str
+    :param block: ``(start, stop)`` of the last axis that this handle
+                  refers to, or ``None`` for all of it.
+    :type block: tuple
+    """
+    def __init__(self, file, block=None):
+        self.file = file
+        """The name of the file that holds the array."""
+        self.block = block
+        self._track()
+
+    def _track(self):
+        cache.acquire(self.file)
+        weakref.finalize(self, cache.release, self.file)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._track()
+
+    @classmethod
+    def create(cls, file, shape, dtype=float):
+        """
+        Creates a file for an array of ``shape`` and returns its handle.
+        Write to it through :meth:`open`.
+        """
+        array = np.lib.format.open_memmap(os.path.join(plugin_cache, file),
+                                          mode='w+', dtype=dtype, shape=shape)
+        del array
+        tensor = cls(file)
+        cache.written(file)
+        return tensor
+
+    def open(self, mode='r'):
+        """
+        Returns the memory-mapped array.
+
+        :param mode: ``'r'`` to read or ``'r+'`` to write.
+        :type mode: str
+        """
+        array = np.load(os.path.join(plugin_cache, self.file), mmap_mode=mode)
+        cache.touch(self.file)
+        if self.block is not None:
+            array = array[..., self.block[0]:self.block[1]]
+        return array
+
+    def view(self, start, stop):
+        """
+        Returns a handle to elements ``start`` to ``stop`` of the last axis.
+        """
+        offset = self.block[0] if self.block is not None else 0
+        return Tensor(self.file, (offset + start, offset + stop))
+
+    @property
+    def shape(self):
+        return self.open().shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.open().dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self.open()[key]
+
+    def __array__(self, dtype=None):
+        array = self.open()
+        return array if dtype is None else array.astype(dtype)
+
+    def __str__(self):
+        return 'Tensor({}, shape={})'.format(self.file, self.shape)
+
+
+def _shape(value):
+    """
+    *Internal*. Returns the shape of an array, :class:`Tensor` or scalar
+    without reading its data.
+    """
+    return tuple(getattr(value, 'shape', np.shape(value)))
+
+
+def _block_shape(initial, parameters):
+    """
+    *Internal*. Returns the shape of the state of a :class:`Recurrence`, the
+    broadcast of its initial values and of one step of its parameters. The
+    last axis holds the policies.
+    """
+    shapes = [_shape(v) for v in initial.values()]
+    for v in parameters.values():
+        shape = _shape(v)
+        shapes.append(shape[1:] if len(shape) > 1 else shape)
+    block = ()
+    for shape in shapes:
+        try:
+            block = np.broadcast(np.broadcast_to(0, block),
+                                 np.broadcast_to(0, shape)).shape
+        except ValueError:
+            raise ValueError('Shapes {} do not broadcast together.'.format(
+                             shapes))
+    return block
+
+
+def _shard(values, start, stop, n):
+    """
+    *Internal*. Returns policies ``start`` to ``stop`` of every variable that
+    has ``n`` of them. Others are broadcast, so are passed as they are.
+    """
+    out = {}
+    for k, v in values.items():
+        shape = _shape(v)
+        if not shape or shape[-1] != n:
+            out[k] = v
+        elif isinstance(v, Tensor):
+            out[k] = v.view(start, stop)
+        else:
+            out[k] = v[..., start:stop]
+    return out
+
+
+def _run_recurrence(initial, step, parameters, periods, out=None):
+    """
+    *Internal*. Runs a :class:`Recurrence` over a block of policies. Returns
+    a ``(periods + 1, *block)`` array for each state variable, or writes them
+    to the :class:`Tensor` handles in ``out`` and returns those. Module level
+    so that blocks can be sent to the worker pool.
+    """
+    exprs = {k: compile_expression(v) for k, v in step.items()}
+    shape = _block_shape(initial, parameters)
+    parameters = {k: v.open() if isinstance(v, Tensor) else v
+                  for k, v in parameters.items()}
+    state = {k: np.broadcast_to(np.asarray(v, dtype=float), shape)
+             for k, v in initial.items()}
+    handles = out
+    if handles is None:
+        out = {k: np.empty((periods + 1,) + shape) for k in state}
+    else:
+        out = {k: handles[k].open('r+') for k in state}
+    for k, v in state.items():
+        out[k][0] = v
+    # parameters that vary over time are indexed once per step
+    varying = {k for k, v in parameters.items() if np.ndim(v) > 1}
+    values = dict(parameters)
+    for t in range(periods):
+        for k in varying:
+            values[k] = parameters[k][t]
+        values.update(state)
+        values['t'] = t
+        # every state variable steps from the values at t
+        state = {k: e(**values) for k, e in exprs.items()}
+        for k, v in state.items():
+            out[k][t + 1] = v
+    if handles is not None:
+        for array in out.values():
+            array.flush()
+        return handles
+    return out
+
+
 class AstColumn(Custom):
     """
     AstColumn produces a vector tranformation using t as the input vector and
@@ -54,48 +480,20 @@ class AstColumn(Custom):
 
     def __init__(self):
         self.return_msg_ = "No problems boss!"
+        self.expression = None
 
     def return_msg(self):
         return self.return_msg_
 
     def process(self):
         expr = str(self.inputs['f(t)'])
-        self.outputs['ans'] = [self._eval_expr(expr.replace('t', str(t)))
-                               for t in self.inputs['t']]
+        if self.expression is None or self.expression.expr != expr:
+            self.expression = AstExpression(expr)
+        t = np.asarray(self.inputs['t'])
+        ans = np.broadcast_to(self.expression(t=t), t.shape)
+        self.outputs['ans'] = ans.tolist()
         return super().process()
 
-    def _eval_expr(self, expr):
-        """
-        *Internal*. Evaluates a string math expression.
-
-        Example::
-
-            >>> _eval_expr('2^6')
-            4
-            >>> _eval_expr('2**6')
-            64
-            >>> _eval_expr('1 + 2*3**(4^5) / (6 + -7)')
-            -5.0
-        """
-        return self._eval(ast.parse(expr, mode='eval').body)
-
-
-    def _eval(self, node):
-        """
-        Recursively evaluates a binary syntax tree. Each node is composed of
-        other nodes, operators, or numbers. When a node is encountered, a
-        a recursion occurs.
-        """
-        if isinstance(node, ast.Num):  # <number>
-            return node.n
-        elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
-            return operators[type(node.op)](self._eval(node.left),
-                                            self._eval(node.right))
-        elif isinstance(node, ast.UnaryOp):  # <operator> <operand> e.g., -1
-            return operators[type(node.op)](self._eval(node.operand))
-        else:
-            raise TypeError(node)
-
 
 class NumpyColumn(Custom):
     """
@@ -126,7 +524,326 @@ class NumpyColumn(Custom):
         return self.return_msg_
 
     def process(self):
-        expr = str(self.inputs['f(t)'])
+        expr = compile_expression(str(self.inputs['f(t)']))
         t = np.array(self.inputs['t'])
-        self.outputs['ans'] = eval(expr)
+        self.outputs['ans'] = expr(t=t)
+        return super().process()
+
+
+class Projection(Custom):
+    """
+    Projection evaluates an expression of several named vectors in a single
+    vectorized pass, so a chain of per-term cells can be collapsed into one.
+    The expression may use everything a :class:`NumpyColumn` expression can.
+
+    Example::
+
+        >>> p = Projection()
+        >>> p.inputs['f'] = 'l * v**t * (1 - q)'
+        >>> p.inputs['variables'] = {'t': np.arange(3), 'v': 1 / 1.05,
+        ...                          'l': [1000, 990, 975],
+        ...                          'q': [0.010, 0.015, 0.020]}
+        >>> p.process()
+        0
+        >>> p.outputs['ans']
+        array([990.        , 928.71428571, 866.66666667])
+
+    :param f: *Required*. The expression.
+    :type f: str
+    :param variables: *Required*. The vectors and scalars the expression
+                      refers to by name. A Series or single-column frame in
+                      an H5 may be given for a vector, or an H5 whose columns
+                      are all variables.
+    :type variables: dict or H5
+    :param chunksize: Number of elements evaluated at a time, to bound the
+                      memory used by intermediate results over long
+                      horizons. Evaluates all at once if not given.
+    :type chunksize: int
+    :param tensor: Write the result to a memory-mapped file and output a
+                   :class:`Tensor`. Vectors may also be given as Tensors;
+                   with ``chunksize`` only one chunk of each is read at a
+                   time.
+    :type tensor: bool
+    :returns: A NumPy array, a Tensor, or an H5 holding a Series on the
+              index of the first H5 variable if any variable came from an
+              H5.
+    :rtype: ndarray, Tensor or H5
+    """
+    inputs = {'f': None, 'variables': {}, 'chunksize': None, 'tensor': False}
+    inflows = ['>>']
+    outputs = {'ans': None}
+    required = ['>>', 'f', 'variables']
+    internal_use = ['>>']
+
+    def __init__(self):
+        self.return_msg_ = 'Ready to project.'
+
+    def return_msg(self):
+        return self.return_msg_
+
+    @staticmethod
+    def resolve(variables, handles=False):
+        """
+        Returns the variables as arrays or scalars, and the index of the first
+        one read from an H5 (or ``None``).
+
+        :param handles: Return :class:`Tensor` variables as they are, to be
+                        opened where they are used.
+        :type handles: bool
+        """
+        index = None
+        if isinstance(variables, H5):
+            df = variables.df
+            index = df.index
+            return {c: df[c].values for c in df.columns}, index
+        values = {}
+        for name, value in variables.items():
+            if isinstance(value, Tensor):
+                if handles:
+                    values[name] = value
+                    continue
+                value = value.open()
+            if isinstance(value, H5):
+                value = value.df
+            if isinstance(value, pd.DataFrame):
+                if len(value.columns) != 1:
+                    raise ValueError('{} must be a single column.'.format(
+                                     name))
+                value = value.iloc[:, 0]
+            if isinstance(value, pd.Series):
+                if index is None:
+                    index = value.index
+                value = value.values
+            elif not np.isscalar(value):
+                value = np.asarray(value)
+            values[name] = value
+        return values, index
+
+    @staticmethod
+    def evaluate(expr, values, chunksize=None, allocate=None):
+        """
+        Evaluates ``expr`` over ``values``, ``chunksize`` elements at a time.
+        Every vector must have the same length; scalars are broadcast.
+
+        :param allocate: Called with the shape and dtype of the result to
+                         get the array it is written to.
+        :type allocate: callable
+        """
+        lengths = {len(v) for v in values.values() if np.ndim(v) > 0}
+        if len(lengths) > 1:
+            raise ValueError('Variables have different lengths: {}'.format(
+                             sorted(lengths)))
+        shape = (lengths.pop(),) if lengths else ()
+        n = shape[0] if shape else 0
+        if not chunksize or chunksize >= n:
+            ans = np.asarray(expr(**values))
+            if allocate is not None:
+                out = allocate(shape, ans.dtype)
+                out[...] = ans
+                return out
+            if ans.shape != shape:
+                ans = np.broadcast_to(ans, shape).copy()
+            return ans
+        allocate = allocate or np.empty
+        out = None
+        for start in range(0, n, chunksize):
+            stop = min(start + chunksize, n)
+            chunk = {k: v[start:stop] if np.ndim(v) > 0 else v
+                     for k, v in values.items()}
+            ans = np.broadcast_to(expr(**chunk), (stop - start,))
+            if out is None:
+                out = allocate((n,), ans.dtype)
+            out[start:stop] = ans
+        return out
+
+    def process(self):
+        tensors = []
+
+        def allocate(shape, dtype):
+            name = '{}.npy'.format(cache.unique(str(self.py_id)))
+            tensors.append(Tensor.create(name, shape, dtype))
+            return tensors[-1].open('r+')
+
+        try:
+            expr = compile_expression(str(self.inputs['f']))
+            values, index = self.resolve(self.inputs['variables'])
+            missing = expr.names - set(values)
+            if missing:
+                raise NameError('Undefined variables: {}'.format(
+                                ', '.join(sorted(missing))))
+            ans = self.evaluate(expr, values, self.inputs['chunksize'],
+                                allocate if self.inputs['tensor'] else None)
+        except (TypeError, ValueError, NameError, SyntaxError) as e:
+            self.fail(str(e))
+            self.outputs['ans'] = None
+            return super().process()
+        if tensors:
+            ans.flush()
+            ans = tensors[-1]
+        elif index is not None:
+            file = '{}.h5'.format(self.py_id)
+            node = 'c{}'.format(self.py_id)
+            results.put(file, node, pd.Series(ans, index=index, name='ans'))
+            ans = H5(file, node)
+        self.outputs['ans'] = ans
+        self.return_msg_ = 'Projected {}.'.format(self.inputs['f'])
+        return super().process()
+
+
+class Recurrence(Custom):
+    """
+    Recurrence projects state variables forward in time, such as reserves or
+    cash flows, for a whole block of policies at once. Each step evaluates
+    the expressions in ``step`` from the state at ``t`` to give the state at
+    ``t + 1``. The time loop runs in Python while each step is vectorized
+    over policies. The expressions may use everything a
+    :class:`NumpyColumn` expression can, the state variables, the
+    parameters and ``t``.
+
+    Example::
+
+        >>> r = Recurrence()
+        >>> r.inputs['initial'] = {'V': 0}
+        >>> r.inputs['step'] = {'V': '(V + P - E) * (1 + i) - q*S'}
+        >>> r.inputs['parameters'] = {'P': [100, 200], 'E': 10, 'i': 0.05,
+        ...                           'q': 0.01, 'S': [1000, 2000]}
+        >>> r.inputs['periods'] = 2
+        >>> r.process()
+        0
+        >>> r.outputs['ans']['V']
+        array([[  0.   ,   0.   ],
+               [ 84.5  , 179.5  ],
+               [173.225, 367.975]])
+
+    The state may have more axes than policies, such as scenarios, as long as
+    policies are on the last one. Its shape is the broadcast of the initial
+    values and of one step of the parameters.
+
+    :param initial: *Required*. The value of each state variable at ``t = 0``,
+                    as a scalar or a vector over policies.
+    :type initial: dict
+    :param step: *Required*. The expression for the next value of each state
+                 variable.
+    :type step: dict
+    :param parameters: Scalars, vectors over policies, or arrays that vary
+                       over time along their first axis, such as
+                       ``(time, policy)`` or ``(time, scenario, 1)``. An H5
+                       may be given whose columns are the per-policy
+                       parameters. Parameters that vary over time may be
+                       Tensors; only one step of them is read at a time.
+    :type parameters: dict or H5
+    :param periods: *Required*. The number of steps to project.
+    :type periods: int
+    :param shards: Number of policy blocks projected in parallel on the
+                   worker pool.
+    :type shards: int
+    :param tensor: Write each state variable to a memory-mapped file and
+                   output :class:`Tensor` handles. Shards write their
+                   policies into the same files.
+    :type tensor: bool
+    :returns: A ``(periods + 1, ...)`` array or Tensor for each state
+              variable.
+    :rtype: dict
+    """
+    inputs = {'initial': {}, 'step': {}, 'parameters': {}, 'periods': None,
+              'shards': 1, 'tensor': False}
+    inflows = ['>>']
+    outputs = {'ans': None}
+    required = ['>>', 'initial', 'step', 'periods']
+    internal_use = ['>>']
+
+    def __init__(self):
+        self.return_msg_ = 'Ready to project.'
+
+    def return_msg(self):
+        return self.return_msg_
+
+    def validate(self, initial, parameters):
+        """
+        Checks that every expression is defined in terms of known names and
+        that the policy blocks are the same size.
+        """
+        step = self.inputs['step']
+        if set(step) != set(initial):
+            raise ValueError('Each state variable needs an initial value and '
+                             'a step.')
+        known = set(initial) | set(parameters) | {'t'}
+        for name, expr in step.items():
+            missing = compile_expression(str(expr)).names - known
+            if missing:
+                raise NameError('Undefined variables in {}: {}'.format(
+                                name, ', '.join(sorted(missing))))
+        periods = self.inputs['periods']
+        for name, value in parameters.items():
+            shape = _shape(value)
+            if len(shape) > 1 and shape[0] < periods:
+                raise ValueError('{} has fewer than {} periods.'.format(
+                                 name, periods))
+        return _block_shape(initial, parameters)
+
+    def tensors(self, shape):
+        """
+        Creates a :class:`Tensor` of ``shape`` for each state variable.
+        """
+        return {k: Tensor.create('{}.npy'.format(cache.unique(
+                                 '{}_{}'.format(self.py_id, k))), shape)
+                for k in self.inputs['step']}
+
+    def sharded(self, initial, step, parameters, periods, out=None):
+        """
+        Projects ``shards`` blocks of policies on the worker pool, or returns
+        ``None`` if there is only one block.
+        """
+        shape = _block_shape(initial, parameters)
+        n = shape[-1] if shape else 1
+        shards = min(self.inputs['shards'] or 1, n)
+        if shards < 2:
+            return None
+        bounds = np.linspace(0, n, shards + 1).astype(int)
+        tasks = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            start, stop = int(start), int(stop)
+            views = None
+            if out is not None:
+                views = {k: v.view(start, stop) for k, v in out.items()}
+            tasks.append((_shard(initial, start, stop, n), step,
+                          _shard(parameters, start, stop, n), periods, views))
+        self.return_msg_ = 'Projecting {} blocks...'.format(shards)
+        parts = pool.map(_run_recurrence, tasks, timeout=self.timeout,
+                         tag=('{}.h5'.format(self.py_id),
+                              'c{}'.format(self.py_id)))
+        if out is not None:
+            return out
+        return {k: np.concatenate([p[k] for p in parts], axis=-1)
+                for k in step}
+
+    def process(self):
+        initial = {k: np.asarray(v) if np.ndim(v) else v
+                   for k, v in self.inputs['initial'].items()}
+        step = {k: str(v) for k, v in self.inputs['step'].items()}
+        periods = self.inputs['periods']
+        self.outputs['ans'] = None
+        try:
+            parameters, _ = Projection.resolve(self.inputs['parameters'],
+                                               handles=True)
+            shape = self.validate(initial, parameters)
+        except (TypeError, ValueError, NameError, SyntaxError) as e:
+            self.fail(str(e))
+            return super().process()
+        handles = None
+        if self.inputs['tensor']:
+            handles = self.tensors((periods + 1,) + shape)
+        try:
+            out = self.sharded(initial, step, parameters, periods, handles)
+        except (TimeoutError, Cancelled) as e:
+            print(e)
+            self.fail(describe(e))
+            return super().process()
+        except WorkerError as e:
+            print(e)
+            out = None
+        if out is None:
+            out = _run_recurrence(initial, step, parameters, periods, handles)
+        self.outputs['ans'] = out
+        self.return_msg_ = 'Projected {} periods.'.format(periods)
         return super().process()
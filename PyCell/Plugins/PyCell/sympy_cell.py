@@ -6,7 +6,11 @@ Provides symbolic math capabilities.
 """
 from Quantum import QuReturnCode
 from PyCell import registry
-from PyCell.custom_cell import Custom
+from PyCell.custom_cell import Custom, on_stop
+from collections import OrderedDict
+import threading
+import numpy as np
+import pandas as pd
 import sympy as sp
 from sympy import (diff, integrate, oo, stats)
 
@@ -77,7 +81,175 @@ tf = {'True':'True', 'False':'False'}
 OK = QuReturnCode('OK')
 QUIT = QuReturnCode('QUIT')
 
-def eval_sym(out_key=None, in_key=None, eval_key='eval', eval_out='result'):
+class ExpressionTable(object):
+    """
+    Interns expressions and their subexpressions, so that structurally
+    identical terms built anywhere in a circuit are the same object. Every
+    :class:`QuSym` interns its expression, so a term shared by several
+    formulas is held once, and hashing and comparing it is an identity check.
+    The table is cleared when a circuit stops.
+
+    This class is thread-safe.
+
+    :param maxsize: Maximum number of expressions held. The least recently
+                    used are dropped first.
+    :type maxsize: int
+    """
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def intern(self, expression):
+        """
+        Returns the interned expression equal to ``expression``, built from
+        interned subexpressions.
+        """
+        with self._lock:
+            return self._intern(expression)
+
+    def _intern(self, expression):
+        existing = self._entries.get(expression)
+        if existing is not None:
+            self._entries.move_to_end(expression)
+            return existing
+        args = tuple(self._intern(arg) for arg in expression.args)
+        if any(a is not b for a, b in zip(args, expression.args)):
+            # without evaluating, so that sympy's own cache does not hand
+            # back an equal node built from other copies of the args
+            try:
+                rebuilt = expression.func(*args, evaluate=False)
+            except TypeError:
+                rebuilt = expression.func(*args)
+            if rebuilt == expression:
+                expression = rebuilt
+        self._entries[expression] = expression
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return expression
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+expressions = ExpressionTable()
+"""The expressions interned by all :class:`QuSym` objects."""
+
+
+@on_stop
+def _clear_expressions(cell):
+    expressions.clear()
+
+
+def _cse_evaluator(args, expressions, modules=None):
+    """
+    *Internal*. Returns a function of ``args`` that evaluates every
+    expression in ``expressions`` and returns their values in a list. The
+    function is generated once, with each common subexpression assigned to
+    a local before the outputs.
+    """
+    return sp.lambdify(args, list(expressions), modules, cse=True)
+
+
+class FunctionCache(object):
+    """
+    Least recently used cache of lambdified functions, shared by every
+    :class:`QuSym` in the process. Entries are keyed by the expression with
+    its variables renamed by position, so structurally identical expressions
+    share a function whatever their symbols are called.
+
+    This class is thread-safe.
+
+    :param maxsize: Maximum number of functions held.
+    :type maxsize: int
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def canonical(expression, variables):
+        """
+        Returns ``expression`` with the variables replaced by positional
+        symbols, and those symbols.
+        """
+        args = tuple(sp.Symbol(f'_x{i}') for i in range(len(variables)))
+        return expression.xreplace(dict(zip(variables, args))), args
+
+    def get(self, expression, variables, modules=None):
+        """
+        Returns ``sp.lambdify(variables, expression, modules)``, compiling
+        it only if an equivalent function is not cached.
+        """
+        expression, args = self.canonical(expression, variables)
+        return self._lookup((expression, args, modules), sp.lambdify)
+
+    def evaluator(self, exprs, variables, modules=None):
+        """
+        Returns a function of ``variables`` that evaluates all of ``exprs``
+        at once, computing their common subexpressions a single time. See
+        :func:`sympy.cse`.
+        """
+        exprs, args = self.canonical(sp.Tuple(*exprs), variables)
+        return self._lookup((exprs, args, modules), _cse_evaluator,
+                            'cse')
+
+    def _lookup(self, key, build, kind='lambdify'):
+        expression, args, modules = key
+        key = (kind,) + key
+        with self._lock:
+            fn = self._entries.get(key)
+            if fn is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return fn
+            self.misses += 1
+        fn = build(args, expression, modules)
+        with self._lock:
+            self._entries[key] = fn
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return fn
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+functions = FunctionCache()
+"""The lambdified functions shared by all :class:`QuSym` objects."""
+
+
+def batch_value(value):
+    """
+    Returns an H5 column, Series or sequence as a NumPy array, so it can be
+    bound to a symbol and evaluated as a batch. Other values are returned as
+    they are.
+    """
+    if not isinstance(value, (pd.Series, pd.DataFrame)):
+        # an H5 is read through its frame, so the dataframe cells need not be
+        # imported
+        value = getattr(value, 'df', value)
+    if isinstance(value, pd.DataFrame):
+        if len(value.columns) != 1:
+            raise ValueError('A batch value must be a single column.')
+        value = value.iloc[:, 0]
+    if isinstance(value, pd.Series):
+        return value.values
+    if isinstance(value, (list, tuple)):
+        return np.asarray(value)
+    return value
+
+
+def eval_sym(out_key=None, in_key=None, eval_key='eval', eval_out='result',
+             values_key=None):
     """
     A decorator for processes that allow calculation of a numeric result. The
     output socket located at ``out_key`` must be a :class:`QuSym`. Optionally,
@@ -97,6 +269,9 @@ def eval_sym(out_key=None, in_key=None, eval_key='eval', eval_out='result'):
     :type eval_key: str or bool
     :param eval_out: The output key where the numeric result is written
     :type eval_out: str
+    :param values_key: The input key containing a dict of values, by symbol
+                       name, that replace those bound in the formula.
+    :type values_key: str
     """
     def magic(process):
         def wrapper(self, *args, **kwargs):
@@ -113,12 +288,26 @@ def eval_sym(out_key=None, in_key=None, eval_key='eval', eval_out='result'):
                 else:
 #                    assert isinstance(self.inputs[in_key], QuSym)
                     fml = self.inputs[in_key]
-                _kwargs = fml.to_dict()
-                vals = _kwargs['values']
+                formulas = fml
+                if isinstance(fml, dict):
+                    formulas = list(fml.values())
+                elif not isinstance(fml, (list, tuple)):
+                    formulas = [fml]
+                vals = tuple(v for f in formulas
+                             for v in f.bindings.values())
                 try:
-                    _result = fml.fn(*vals)
+                    values = None
+                    if values_key is not None:
+                        values = self.inputs[values_key]
+                    if isinstance(fml, QuSym):
+                        _result = fml.evaluate(values)
+                    elif isinstance(fml, dict):
+                        _result = dict(zip(fml, evaluate_all(formulas,
+                                                             values)))
+                    else:
+                        _result = evaluate_all(formulas, values)
                     self.outputs[eval_out] = _result
-                except TypeError as e:
+                except (TypeError, ValueError) as e:
                     self.return_msg_ = (
                         f'Unable to calculate result. '
                         f'Unacceptable parameter value in {vals}'
@@ -129,49 +318,199 @@ def eval_sym(out_key=None, in_key=None, eval_key='eval', eval_out='result'):
     return magic
 
 
+def _override(variables, vals, values):
+    """
+    *Internal*. Returns ``vals`` with those named in ``values`` replaced.
+    """
+    vals = list(vals)
+    if values:
+        for i, variable in enumerate(variables):
+            if str(variable) in values:
+                vals[i] = batch_value(values[str(variable)])
+    return vals
+
+
+def _batch_shape(vals):
+    """
+    *Internal*. Returns the broadcast shape of ``vals``, or ``None`` if they
+    are all scalars.
+    """
+    if not any(np.ndim(v) > 0 for v in vals):
+        return None
+    shape = ()
+    for v in vals:
+        shape = np.broadcast(np.broadcast_to(0, shape), v).shape
+    return shape
+
+
+def _fill(result, shape):
+    """
+    *Internal*. Broadcasts a batch result to ``shape``, as it is a scalar if
+    the expression does not depend on the batch values.
+    """
+    result = np.asarray(result)
+    if result.shape != shape:
+        result = np.broadcast_to(result, shape).copy()
+    return result
+
+
+def evaluate_all(formulas, values=None):
+    """
+    Evaluates several :class:`QuSym` formulas with a single evaluator, so the
+    terms they share are computed once. Their bound values are merged, and
+    batches are evaluated as in :meth:`QuSym.evaluate`.
+
+    :param formulas: The formulas to evaluate.
+    :type formulas: list
+    :param values: Values by symbol name that replace those bound to the
+                   formulas.
+    :type values: dict
+    :returns: The value of each formula.
+    :rtype: list
+    """
+    bound = OrderedDict()
+    for fml in formulas:
+        for variable, value in fml.bindings.items():
+            _bind(bound, variable, value)
+    variables = tuple(bound)
+    vals = _override(variables, bound.values(), values)
+    shape = _batch_shape(vals)
+    modules = None if shape is None else 'numpy'
+    fn = functions.evaluator([fml.expression for fml in formulas], variables,
+                             modules)
+    results = fn(*vals)
+    if shape is not None:
+        results = [_fill(r, shape) for r in results]
+    return list(results)
+
+
+class BindingConflict(ValueError):
+    """
+    Raised when formulas that bind the same symbol to different values are
+    combined.
+    """
+    pass
+
+
+def _same_value(a, b):
+    """
+    *Internal*. Checks if two bound values are the same, element-wise for
+    arrays. NaN is the same as NaN.
+    """
+    if a is b:
+        return True
+    try:
+        if np.ndim(a) or np.ndim(b):
+            try:
+                return bool(np.array_equal(a, b, equal_nan=True))
+            except TypeError:
+                # arrays of objects or strings cannot be checked for NaN
+                return bool(np.array_equal(a, b))
+        return bool(a == b) or bool(np.isnan(a) and np.isnan(b))
+    except Exception:
+        return False
+
+
+def _bind(bindings, variable, value):
+    """
+    *Internal*. Binds ``variable`` to ``value`` in ``bindings``. A value of
+    ``None`` leaves the symbol unbound, so it never conflicts.
+
+    :raises BindingConflict: If ``variable`` is bound to another value.
+    """
+    current = bindings.get(variable)
+    if current is None:
+        bindings[variable] = value
+    elif value is not None and not _same_value(current, value):
+        raise BindingConflict(f'{variable} is bound to both {current} and '
+                              f'{value}.')
+
+
 class QuSym(object):
     """
     An object that combines symbolic representation with numeric evaluation.
+
+    The values of its symbols are held in an ordered mapping from symbol to
+    value. Combining formulas merges their mappings one symbol at a time,
+    and a symbol bound to different values raises :class:`BindingConflict`.
+    Formulas that add no new bindings share the mapping of their operand, so
+    it must not be modified.
+
+    :param expression: A symbol name, or a SymPy expression.
+    :type expression: str or sympy.Basic
+    :param variables: The symbols of ``expression``, with ``values``.
+    :type variables: tuple
+    :param values: The value of each symbol, or of the named symbol.
+    :param bindings: The value of each symbol, in place of ``variables``
+                     and ``values``.
+    :type bindings: OrderedDict
     """
-    def __init__(self, expression, variables=None, values=None):
+    def __init__(self, expression, variables=None, values=None,
+                 bindings=None):
         if isinstance(expression, str):
             assert not isinstance(values, tuple)
             self._expression = sp.Symbol(expression)
-            self._variables = (self._expression,)
-            self._values = (values,)
+            self._bindings = OrderedDict([(self._expression, values)])
         else:
             assert isinstance(expression, sp.Basic)
-            assert isinstance(variables, tuple)
-            assert isinstance(values, tuple)
-            self._expression = expression
-            self._variables = variables
-            self._values = values
+            self._expression = expressions.intern(expression)
+            if bindings is None:
+                assert isinstance(variables, tuple)
+                assert isinstance(values, tuple)
+                bindings = OrderedDict()
+                for variable, value in zip(variables, values):
+                    _bind(bindings, variable, value)
+            elif not isinstance(bindings, OrderedDict):
+                bindings = OrderedDict(bindings)
+            self._bindings = bindings
 
         self._fn = None
 
+    @property
+    def bindings(self):
+        """The value of each symbol, in order."""
+        return self._bindings
+
+    @property
+    def _variables(self):
+        return tuple(self._bindings)
+
+    @property
+    def _values(self):
+        return tuple(self._bindings.values())
+
     def to_dict(self):
         return {'variables': self._variables, 'values': self._values}
     
     def to_tuples(self):
-        return tuple(zip(self._variables, self._values))
+        return tuple(self._bindings.items())
     
+    def _merge(self, other):
+        """
+        *Internal*. Returns the bindings of this formula and ``other``.
+        """
+        merged = self._bindings
+        if other._bindings is merged:
+            return merged
+        for variable, value in other._bindings.items():
+            if variable in merged:
+                current = merged[variable]
+                if value is None or (current is not None and
+                                     _same_value(current, value)):
+                    continue
+            if merged is self._bindings:
+                merged = merged.copy()
+            _bind(merged, variable, value)
+        return merged
+
     def _combine_params(self, other):
-        newtups = self.to_tuples()
-        to_add = other.to_tuples()
-        for tup in to_add:
-            if tup not in newtups:
-                newtups += (tup,)
-        newvars = tuple([i[0] for i in newtups])
-        newvals = tuple([i[1] for i in newtups])
-        return {'variables': newvars, 'values': newvals}
+        return {'bindings': self._merge(other)}
  
     def _op(self, expr, other):
-        _kwargs = self.to_dict()
-        try:
-            _kwargs = self._combine_params(other)
-        except AttributeError:
-            pass
-        return QuSym(expr, **_kwargs)
+        bindings = self._bindings
+        if isinstance(other, QuSym):
+            bindings = self._merge(other)
+        return QuSym(expr, bindings=bindings)
     
     def __add__(self, other):
         val = None
@@ -240,20 +579,40 @@ class QuSym(object):
     @property
     def fn(self):
         if self._fn is None:
-            self._fn = sp.lambdify(self._variables, self._expression)
+            self._fn = functions.get(self._expression, self._variables)
         return self._fn
+
+    def evaluate(self, values=None):
+        """
+        Returns the numeric value of the expression. If any value is an
+        array, the expression is evaluated once over the whole batch with the
+        numpy backend, and the values are broadcast against each other.
+
+        :param values: Values by symbol name that replace those bound to the
+                       expression. H5 columns and Series are accepted.
+        :type values: dict
+        :raises ValueError: If array values do not broadcast together.
+        """
+        vals = _override(self._variables, self._values, values)
+        shape = _batch_shape(vals)
+        if shape is None:
+            return self.fn(*vals)
+        fn = functions.get(self._expression, self._variables, 'numpy')
+        return _fill(fn(*vals), shape)
     
     def subs(self, subexpr, replacement):
         assert isinstance(subexpr, QuSym)
         assert isinstance(replacement, QuSym)
         newsym = self.expression.subs(subexpr.expression,
                                       replacement.expression)
-        newtups = tuple([x for x in self.to_tuples() if x not in 
-                         subexpr.to_tuples()])
-        newtups += replacement.to_tuples()
-        vars = tuple([i[0] for i in newtups])
-        vals = tuple([i[1] for i in newtups])
-        return QuSym(newsym, variables=vars, values=vals)
+        # symbols that were only in the replaced subexpression are dropped
+        free = newsym.free_symbols
+        bindings = OrderedDict(
+            (k, v) for k, v in self._bindings.items()
+            if k in free or k not in subexpr._bindings)
+        for variable, value in replacement._bindings.items():
+            _bind(bindings, variable, value)
+        return QuSym(newsym, bindings=bindings)
 
     @property
     def expression(self):
@@ -337,8 +696,10 @@ class Symbol(Custom):
 
     :param name: The symbol's name. This is what gets printed in latex output.
     :type name: String
-    :param value: The input value that will be used for computation.
-    :type value: numeric
+    :param value: The input value that will be used for computation. An
+                  array, sequence or H5 column binds a batch of values that
+                  are evaluated together.
+    :type value: numeric, array or H5
     """
     inputs = {'name': None, 'value': None}
     outputs = {'symbol': None}
@@ -346,8 +707,8 @@ class Symbol(Custom):
     threadsafe = True
     
     def process(self):
-        self.outputs['symbol'] = QuSym(self.inputs['name'],
-                                       values=self.inputs['value'])
+        value = batch_value(self.inputs['value'])
+        self.outputs['symbol'] = QuSym(self.inputs['name'], values=value)
 
         return super().process()
 
@@ -406,7 +767,7 @@ class CDF(Custom):
         assert isinstance(self.inputs['z'], QuSym)
         dist = stats.cdf(self.inputs['distribution'])
         expr = dist(self.inputs['z'].expression)
-        _kwargs = self.inputs['z'].to_dict()
+        _kwargs = {'bindings': self.inputs['z'].bindings}
         self.outputs['CDF'] = QuSym(expr, **_kwargs)
         return super().process()
 
@@ -429,7 +790,7 @@ class Exp(Custom):
         
     @eval_sym(out_key='f(x)', eval_key='eval', eval_out='result')
     def process(self):
-        _kwargs = self.inputs['x'].to_dict()
+        _kwargs = {'bindings': self.inputs['x'].bindings}
         outSym = sp.exp(self.inputs['x'].expression)
         self.outputs['f(x)'] = QuSym(outSym, **_kwargs)
         return super().process()
@@ -453,7 +814,7 @@ class Ln(Custom):
         
     @eval_sym(out_key='f(x)', eval_key='eval', eval_out='result')
     def process(self):
-        _kwargs = self.inputs['x'].to_dict()
+        _kwargs = {'bindings': self.inputs['x'].bindings}
         outSym = sp.ln(self.inputs['x'].expression)
         self.outputs['f(x)'] = QuSym(outSym, **_kwargs)
         return super().process()
@@ -477,7 +838,7 @@ class Sqrt(Custom):
         
     @eval_sym(out_key='f(x)', eval_key='eval', eval_out='result')
     def process(self):
-        _kwargs = self.inputs['x'].to_dict()
+        _kwargs = {'bindings': self.inputs['x'].bindings}
         outSym = sp.sqrt(self.inputs['x'].expression)
         self.outputs['f(x)'] = QuSym(outSym, **_kwargs)
         return super().process()
@@ -487,13 +848,23 @@ class Calculate(Custom):
     """
     Converts a QuSym into a function and calculates the value given supplied
     input variables.
+
+    :param f(x): The formula, or a list or dict of formulas. Several
+                 formulas are evaluated together and their shared terms are
+                 computed once.
+    :type f(x): QuSym, list or dict
+    :param values: Values by symbol name that replace those bound in
+                   ``f(x)``. Arrays and H5 columns evaluate the formula for
+                   every element in one call, such as every policy in a
+                   portfolio.
+    :type values: dict
     """
-    inputs = {'f(x)': None}
+    inputs = {'f(x)': None, 'values': {}}
     outputs = {'result': None}
     required = ['f(x)']
     threadsafe = False
     
-    @eval_sym(in_key='f(x)', eval_key=True)
+    @eval_sym(in_key='f(x)', eval_key=True, values_key='values')
     def process(self):
         return super().process()
 
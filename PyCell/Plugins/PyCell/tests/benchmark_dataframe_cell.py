@@ -0,0 +1,267 @@
+"""
+Benchmarks for the dataframe cells. Each benchmark runs a cell over a
+synthetic frame of policies and reports the wall time, the peak resident
+memory of PyCell and its worker processes, the growth of the data store in
+``plugin_cache`` and the number of processes spawned.
+
+To run the benchmarks from Quantum's interactive console:
+>>> exec(open('plugins/PyCell/tests/benchmark_dataframe_cell.py').read())
+
+They do not need Quantum's UI, and can be run headless from the
+``Plugins`` directory::
+
+    $ python -m PyCell.tests.benchmark_dataframe_cell --rows 1e3 1e5 1e7
+
+Peak memory and spawn counts include worker processes only if ``psutil`` is
+installed. Otherwise they are taken from the operating system's high-water
+mark for this process and from the worker pool.
+"""
+import argparse
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+import pandas as pd
+from PyCell import dataframe_cell
+from PyCell.dataframe_cell import H5, results, frame_cache, plugin_cache
+from PyCell.worker_pool import pool
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_ids = itertools.count(1000000)
+
+
+def synthetic(rows, seed=0):
+    """
+    Returns a frame of ``rows`` policy quarters with a unique
+    ``(policy, quarter)`` pair on each row.
+    """
+    rng = np.random.RandomState(seed)
+    regions = np.array(['north', 'south', 'east', 'west', 'central'])
+    return pd.DataFrame({'policy': np.arange(rows) // 10,
+                         'quarter': np.arange(rows) % 10,
+                         'age': rng.randint(18, 90, rows),
+                         'region': regions[rng.randint(0, 5, rows)],
+                         'premium': rng.gamma(2.0, 500.0, rows)})
+
+
+def assumptions():
+    """
+    Returns a table of rates by age.
+    """
+    ages = np.arange(18, 90)
+    return pd.DataFrame({'age': ages, 'rate': 0.0005 * np.exp(0.08 * ages)})
+
+
+def cell(cls, **inputs):
+    """
+    Returns a cell with a unique ``py_id`` and the given inputs.
+    """
+    c = cls()
+    c.py_id = next(_ids)
+    for k, v in inputs.items():
+        c.inputs[k] = v
+    return c
+
+
+def run(c, output):
+    c.process()
+    return c.outputs[output]
+
+
+def cache_bytes():
+    """
+    Returns the size of every file in ``plugin_cache``.
+    """
+    total = 0
+    for root, dirs, files in os.walk(plugin_cache):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+class Monitor(threading.Thread):
+    """
+    Samples the resident memory of this process and its children until
+    stopped.
+    """
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self.pids = set()
+        self._done = threading.Event()
+        self._known = set()
+        if psutil is not None:
+            self._known = {p.pid for p in psutil.Process().children(True)}
+
+    def sample(self):
+        proc = psutil.Process()
+        rss = 0
+        for p in [proc] + proc.children(recursive=True):
+            try:
+                rss += p.memory_info().rss
+            except psutil.Error:
+                continue
+            if p.pid != proc.pid and p.pid not in self._known:
+                self.pids.add(p.pid)
+        self.peak = max(self.peak, rss)
+
+    def run(self):
+        if psutil is None:
+            return
+        self.sample()
+        while not self._done.wait(self.interval):
+            self.sample()
+        self.sample()
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        if psutil is None and resource is not None:
+            # ru_maxrss is in kilobytes on Linux
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            self.peak = usage.ru_maxrss * 1024
+
+
+def measure(name, rows, func, repeat=3):
+    """
+    Runs ``func`` ``repeat`` times and returns the fastest wall time with the
+    largest peak memory, cache growth and spawn count seen.
+    """
+    record = {'name': name, 'rows': rows, 'seconds': None, 'peak_rss': 0,
+              'cache_bytes': 0, 'spawns': 0}
+    for _ in range(repeat):
+        frame_cache.clear()
+        spawns = pool.spawns
+        before = cache_bytes()
+        monitor = Monitor()
+        monitor.start()
+        start = time.perf_counter()
+        try:
+            out = func()
+        finally:
+            seconds = time.perf_counter() - start
+            monitor.stop()
+        written = cache_bytes() - before
+        if psutil is not None:
+            spawned = len(monitor.pids)
+        else:
+            spawned = pool.spawns - spawns
+        if isinstance(out, H5):
+            results.discard(out.file, out.node)
+        if record['seconds'] is None or seconds < record['seconds']:
+            record['seconds'] = seconds
+        record['peak_rss'] = max(record['peak_rss'], monitor.peak)
+        record['cache_bytes'] = max(record['cache_bytes'], written)
+        record['spawns'] = max(record['spawns'], spawned)
+    return record
+
+
+def benchmarks(rows, workdir):
+    """
+    Writes the inputs for ``rows`` and returns ``(name, func)`` pairs.
+    """
+    df = synthetic(rows)
+    csv = os.path.join(workdir, 'policies_{}.csv'.format(rows))
+    df.to_csv(csv, index=False)
+    h5 = H5('bench_{}.h5'.format(rows), 'policies', df,
+            data_columns=['policy', 'age', 'region'], storage='intermediate')
+    rates = H5('bench_rates.h5', 'rates', assumptions(),
+               data_columns=['age'], storage='intermediate')
+    premium = run(cell(dataframe_cell.Column, data=h5, columns='premium'),
+                  'data')
+    age = run(cell(dataframe_cell.Column, data=h5, columns='age'), 'data')
+    premium.flush()
+    age.flush()
+
+    def read_csv():
+        # a new modification time forces a fresh ingestion
+        stamp = time.time()
+        os.utime(csv, (stamp, stamp))
+        return cell(dataframe_cell.Read_CSV, csv=csv, chunksize=500000,
+                    infer_datetime_format=False).read_csv()
+
+    return [
+        ('read_csv', read_csv),
+        ('column', lambda: run(cell(dataframe_cell.Column, data=h5,
+                                    columns=['policy', 'premium']), 'data')),
+        ('select', lambda: run(cell(dataframe_cell.Select, data=h5,
+                                    expression='age > 80'), 'dataframe')),
+        ('select_pushdown', lambda: run(cell(dataframe_cell.Select, data=h5,
+                                             sieve=age > 80), 'dataframe')),
+        ('groupby', lambda: run(cell(dataframe_cell.GroupBy, dataframe=h5,
+                                     columns='region', aggregation='mean'),
+                                'data')),
+        ('groupby_partitioned', lambda: run(cell(
+            dataframe_cell.GroupBy, dataframe=h5, columns='region',
+            aggregation='mean', partitions=pool.size), 'data')),
+        ('merge', lambda: run(cell(dataframe_cell.Merge, A=h5, B=rates,
+                                   on='age', how='left'), 'dataframe')),
+        ('merge_bucketed', lambda: run(cell(
+            dataframe_cell.Merge, A=h5, B=rates, on='age', how='left',
+            buckets=pool.size), 'dataframe')),
+        ('pivot', lambda: run(cell(dataframe_cell.Pivot, dataframe=h5,
+                                   index='policy', columns='quarter',
+                                   values='premium'), 'dataframe')),
+        ('add', lambda: premium + 1.0),
+        ('gt', lambda: premium > 1000.0),
+    ]
+
+
+def run_benchmarks(rows=(1000, 100000), repeat=3, only=None, output=None):
+    """
+    Runs every benchmark for each size in ``rows``, prints a table and
+    returns the records. If ``output`` is given, the records are also written
+    to it as JSON.
+    """
+    records = []
+    print('{:<20} {:>10} {:>10} {:>10} {:>12} {:>7}'.format(
+          'benchmark', 'rows', 'seconds', 'peak MB', 'cache MB', 'spawns'))
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in rows:
+            for name, func in benchmarks(int(n), workdir):
+                if only and name not in only:
+                    continue
+                record = measure(name, int(n), func, repeat)
+                records.append(record)
+                print('{name:<20} {rows:>10} {seconds:>10.3f} {:>10.1f} '
+                      '{:>12.1f} {spawns:>7}'.format(
+                          record['peak_rss'] / 2**20,
+                          record['cache_bytes'] / 2**20, **record))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(records, f, indent=2)
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the PyCell dataframe cells.')
+    parser.add_argument('--rows', nargs='+', type=float, default=[1e3, 1e5],
+                        help='frame sizes to benchmark')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark; the fastest is reported')
+    parser.add_argument('--only', nargs='+',
+                        help='names of the benchmarks to run')
+    parser.add_argument('--output', help='write the records to a JSON file')
+    args = parser.parse_args(argv)
+    run_benchmarks(args.rows, args.repeat, args.only, args.output)
+
+
+if __name__ == '__main__':
+    main()
+elif __name__ == 'builtins':
+    run_benchmarks()
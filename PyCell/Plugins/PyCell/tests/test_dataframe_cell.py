@@ -1,12 +1,39 @@
+import os
+import shutil
 import dataframe_cell
-from dataframe_cell import H5
+from dataframe_cell import H5, results, plugin_cache, frame_cache
+from worker_pool import pool, WorkerPool, WorkerCrashed
+import custom_cell
+from custom_cell import Custom, profiler, on_stop
 import unittest
 import Quantum
 from Quantum import QuCell, QuCircuit, QuScheduler
+import numpy as np
 import pandas as pd
+import time
+import tempfile
+import threading
 from ctrl_console import console_printer
 
 
+class Sleepy(Custom):
+    """
+    Sleeps on a worker before passing its input through.
+    """
+    inputs = {'data': None, 'seconds': 5}
+    outputs = {'data': None}
+    timeout = 0.5
+
+    @dataframe_cell.data_process
+    def sleep(self, h5):
+        time.sleep(self.inputs['seconds'])
+        return h5.df
+
+    def process(self):
+        self.outputs['data'] = self.sleep(self.inputs['data'])
+        return super().process()
+
+
 class Test_DataFrameCells(unittest.TestCase):
     def setUp(self):
         self.csv = 'titles.csv'
@@ -18,6 +45,50 @@ class Test_DataFrameCells(unittest.TestCase):
         self.assertTrue(isinstance(self.csv_cell.outputs['dataframe'].value.df,
                                    pd.DataFrame))
 
+    def test_read_csv_chunks(self):
+        self.csv_cell.process(0)
+        whole = self.csv_cell.outputs['dataframe'].value.df
+        self.csv_cell.inputs['chunksize'] << 100
+        self.csv_cell.process(0)
+        chunked = self.csv_cell.outputs['dataframe'].value.df
+        self.assertEqual(len(chunked), len(whole))
+        self.assertEqual(list(chunked.columns), list(whole.columns))
+
+    def test_read_csv_reuse(self):
+        reader = dataframe_cell.Read_CSV()
+        reader.inputs['csv'] = self.csv
+        reader.inputs['infer_datetime_format'] = False
+        first = reader.read_csv()
+        second = reader.read_csv()
+        self.assertEqual(first.file, second.file)
+        self.assertTrue(reader.return_msg_.startswith('Reusing'))
+
+    def test_read_csv_cancel(self):
+        fd, csv = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as f:
+            f.write('a,b\n')
+            f.writelines('{},{}\n'.format(i, i * 2) for i in range(200000))
+        reader = dataframe_cell.Read_CSV()
+        reader.inputs['csv'] = csv
+        reader.inputs['chunksize'] = 100
+        done = threading.Event()
+
+        def stop():
+            # wait for the reader to start before cancelling it
+            while not dataframe_cell.cancel() and not done.wait(0.05):
+                pass
+        thread = threading.Thread(target=stop)
+        thread.start()
+        try:
+            code = reader.process()
+        finally:
+            done.set()
+            thread.join()
+            os.remove(csv)
+        self.assertIsNone(reader.outputs['dataframe'])
+        self.assertNotEqual(code, Quantum.QuReturnCode('OK').returncode)
+        self.assertEqual(reader.return_msg(), 'Cancelled.')
+
     def test_circuit_editing(self):
         self.csv_cell.inputs['index_col'] << None
         c1 = QuCell('Quantum::PyCell::Custom::Column')
@@ -86,6 +157,412 @@ class Test_DataFrameCells(unittest.TestCase):
         s.execute(1)
         self.assertEqual(len(tail.outputs['dataframe'].value.df), 5)
 
+    def test_worker_reuse(self):
+        head = QuCell('Quantum::PyCell::Custom::Head')
+        c = QuCircuit()
+        c.insert(head)
+        c.insert(self.csv_cell)
+        c.connect(self.csv_cell, 'dataframe', head, 'data')
+        s = QuScheduler(c)
+        s.execute(1)
+        spawns = pool.spawns
+        # re-running the same cell should reuse a warm worker
+        for n in range(3, 6):
+            head.inputs['n'] << n
+            s.execute(1)
+            self.assertEqual(len(head.outputs['dataframe'].value.df), n)
+        self.assertEqual(pool.spawns, spawns)
+
+    def test_in_memory_handoff(self):
+        c1 = QuCell('Quantum::PyCell::Custom::Column')
+        c1.inputs['columns'] << 'year'
+        c2 = QuCell('Quantum::PyCell::Custom::Eq')
+        c2.inputs['b'] << 2
+        c = QuCircuit()
+        c.insert(self.csv_cell)
+        c.insert(c1)
+        c.insert(c2)
+        c.connect(self.csv_cell, 'dataframe', c1, 'data')
+        c.connect(c1, 'data', c2, 'a')
+        s = QuScheduler(c)
+        s.execute(1)
+        col = c1.outputs['data'].value
+        out = c2.outputs['result'].value
+        self.assertTrue(col.in_memory)
+        self.assertTrue(out.in_memory)
+        self.assertTrue(isinstance(out.df, pd.Series))
+
+        # spilled frames are read back from the data store
+        budget = results.budget
+        results.budget = 0
+        try:
+            results.put(out.file, out.node, out.df)
+            self.assertFalse(out.in_memory)
+            self.assertTrue(isinstance(out.df, pd.Series))
+        finally:
+            results.budget = budget
+
+    def test_in_memory_column(self):
+        df = pd.DataFrame({'a': range(5), 'b': range(5), 'c': range(5)},
+                          index=list('vwxyz'))
+        results.put('test_memory_column.h5', 'data', df,
+                    data_columns=['a', 'b'])
+        col = dataframe_cell.Column()
+        col.py_id = 3002
+        col.inputs['data'] = H5('test_memory_column.h5', 'data')
+        col.inputs['columns'] = ['a', 'c']
+        col.process()
+        out = col.outputs['data']
+        self.assertTrue(out.in_memory)
+        self.assertEqual(list(out.df.index), list('vwxyz'))
+        self.assertEqual(out.data_columns, ['a'])
+        # the input was never flushed to the data store
+        self.assertFalse(os.path.exists(
+            os.path.join(plugin_cache, 'test_memory_column.h5')))
+
+    def test_worker_transport(self):
+        c1 = QuCell('Quantum::PyCell::Custom::Column')
+        c1.inputs['columns'] << 'year'
+        c2 = QuCell('Quantum::PyCell::Custom::Value_Counts')
+        c = QuCircuit()
+        c.insert(self.csv_cell)
+        c.insert(c1)
+        c.insert(c2)
+        c.connect(self.csv_cell, 'dataframe', c1, 'data')
+        c.connect(c1, 'data', c2, 'series')
+        s = QuScheduler(c)
+        s.execute(1)
+        out = c2.outputs['series'].value
+        # the worker result is mapped back in without an HDF5 round trip
+        self.assertTrue(out.in_memory)
+        self.assertFalse(os.path.exists(os.path.join(plugin_cache, out.file)))
+        self.assertTrue(isinstance(out.df, pd.Series))
+
+    def test_frame_cache(self):
+        self.csv_cell.process(0)
+        h5 = self.csv_cell.outputs['dataframe'].value
+        first = h5.df
+        hits = frame_cache.hits
+        # a second proxy for the same node is served from the cache
+        self.assertTrue(H5(h5.file, h5.node).df is first)
+        self.assertEqual(frame_cache.hits, hits + 1)
+
+        # rewriting the node invalidates it
+        H5(h5.file, h5.node, first.head(), data_columns=h5.data_columns)
+        self.assertEqual(len(h5.df), 5)
+
+    def test_storage_policy(self):
+        self.csv_cell.process(0)
+        df = self.csv_cell.outputs['dataframe'].value.df
+        fast = H5('test_fast.h5', 'fast', df, storage='fast')
+        final = H5('test_final.h5', 'final', df, storage='final')
+        self.assertEqual(len(fast.df), len(final.df))
+        self.assertEqual(list(fast.data_columns), [])
+        self.assertLess(os.path.getsize(os.path.join(plugin_cache, final.file)),
+                        os.path.getsize(os.path.join(plugin_cache, fast.file)))
+
+    def test_lazy_plan(self):
+        self.csv_cell.process(0)
+        h5 = self.csv_cell.outputs['dataframe'].value
+        df = h5.df
+        dataframe_cell.lazy = True
+        try:
+            head = dataframe_cell.Head()
+            head.inputs['data'] << h5
+            head.inputs['n'] << 3
+            head.process()
+            out = head.outputs['dataframe']
+        finally:
+            dataframe_cell.lazy = False
+        # nothing is computed until the data is read
+        self.assertEqual(out.plan, (('head', 3),))
+        self.assertTrue(out.df.equals(df.head(3)))
+        self.assertTrue(out.in_memory)
+
+    def test_lazy_columns(self):
+        df = pd.DataFrame({'a': range(10), 'b': [float(i) for i in range(10)]})
+        h5 = H5('test_lazy_columns.h5', 'data', df)
+        out = h5.defer('columns', ['b'])
+        # the columns are read from the table and spilled to a new file
+        self.assertTrue(out.df.equals(df[['b']]))
+        self.assertNotEqual(out.materialize().file, h5.file)
+        with h5.store as store:
+            self.assertEqual(store.keys(), ['/data'])
+
+    def test_store_metadata(self):
+        df = pd.DataFrame({'a': range(10), 'b': range(10)})
+        table = H5('test_metadata.h5', 'data', df, data_columns=['a'])
+        self.assertTrue(table.is_table)
+        self.assertEqual(list(table.data_columns), ['a'])
+        self.assertTrue(table.select_column('a').equals(df['a']))
+        fixed = H5('test_metadata_fast.h5', 'data', df, storage='fast')
+        self.assertFalse(fixed.is_table)
+        results.put('test_metadata_memory.h5', 'data', df)
+        memory = H5('test_metadata_memory.h5', 'data')
+        self.assertFalse(memory.is_table)
+        self.assertFalse(os.path.exists(
+            os.path.join(plugin_cache, 'test_metadata_memory.h5')))
+
+    def test_predicate_pushdown(self):
+        self.csv_cell.process(0)
+        df = self.csv_cell.outputs['dataframe'].value.df
+        h5 = H5('test_pushdown.h5', 'titles', df, data_columns=['year'])
+        column = dataframe_cell.Column()
+        column.inputs['data'] = h5
+        column.inputs['columns'] = 'year'
+        column.process()
+        sieve = column.outputs['data'] > 2000
+        # the comparison is kept as a where condition on the source node
+        self.assertEqual(sieve.condition, 'year > 2000')
+        select = dataframe_cell.Select()
+        select.inputs['data'] = h5
+        select.inputs['sieve'] = sieve
+        select.process()
+        self.assertEqual(len(select.outputs['dataframe'].df),
+                         (df['year'] > 2000).sum())
+        self.assertTrue(sieve.df.equals(df['year'] > 2000))
+        # numpy scalars are written as plain literals
+        sieve = column.outputs['data'] > np.int64(2000)
+        self.assertEqual(sieve.condition, 'year > 2000')
+
+    def test_predicate_memory(self):
+        df = pd.DataFrame({'year': [1999, 2001, 2003], 'n': [1, 2, 3]})
+        results.put('test_pushdown_memory.h5', 'data', df,
+                    data_columns=['year'])
+        fast = H5('test_pushdown_fast.h5', 'data', df, storage='fast')
+        for h5 in (H5('test_pushdown_memory.h5', 'data'), fast):
+            column = dataframe_cell.Column()
+            column.inputs['data'] = h5
+            column.inputs['columns'] = 'year'
+            column.process()
+            # only tables in the data store are queried with a condition
+            sieve = column.outputs['data'] > 2000
+            self.assertIsNone(sieve.condition)
+            select = dataframe_cell.Select()
+            select.inputs['data'] = h5
+            select.inputs['sieve'] = sieve
+            select.process()
+            self.assertEqual(list(select.outputs['dataframe'].df['n']),
+                             [2, 3])
+        self.assertFalse(os.path.exists(
+            os.path.join(plugin_cache, 'test_pushdown_memory.h5')))
+
+    def test_predicate_names(self):
+        df = pd.DataFrame({'start year': [1999, 2001, 2003]})
+        h5 = H5('test_pushdown_names.h5', 'data', df,
+                data_columns=['start year'])
+        column = dataframe_cell.Column()
+        column.inputs['data'] = h5
+        column.inputs['columns'] = 'start year'
+        column.process()
+        # a column name that is not an identifier is compared in memory
+        sieve = column.outputs['data'] > 2000
+        self.assertIsNone(sieve.condition)
+        self.assertEqual(list(sieve.df), [False, True, True])
+
+    def test_partitioned_groupby(self):
+        df = pd.DataFrame({'policy': [i % 7 for i in range(1000)],
+                           'value': [float(i % 13) for i in range(1000)]})
+        h5 = H5('test_groupby.h5', 'policies', df, storage='intermediate')
+        for method in ['size', 'sum', 'mean', 'std', {'value': ['min', 'max']}]:
+            group = dataframe_cell.GroupBy()
+            group.inputs['dataframe'] = h5
+            group.inputs['columns'] = 'policy'
+            group.inputs['aggregation'] = method
+            group.inputs['partitions'] = 3
+            expected = dataframe_cell.GroupBy.aggregate(df, 'policy', method)
+            result = group.partitioned(h5).df
+            self.assertTrue(result.index.equals(expected.index))
+            self.assertTrue(((result - expected).abs() < 1e-9).values.all())
+
+    def test_bucketed_merge(self):
+        a = pd.DataFrame({'policy': [i % 50 for i in range(500)],
+                          'value': [float(i) for i in range(500)]})
+        b = pd.DataFrame({'policy': list(range(60)),
+                          'rate': [i / 100 for i in range(60)]})
+        h5a = H5('test_merge_a.h5', 'a', a, data_columns=['policy', 'value'])
+        h5b = H5('test_merge_b.h5', 'b', b, data_columns=['policy'])
+        merged = []
+        for buckets in [1, 4]:
+            merge = dataframe_cell.Merge()
+            merge.inputs['A'] = h5a
+            merge.inputs['B'] = h5b
+            merge.inputs['how'] = 'outer'
+            merge.inputs['on'] = 'policy'
+            merge.inputs['buckets'] = buckets
+            merge.process()
+            merged.append(merge.outputs['dataframe'].df.sort_index())
+        self.assertEqual(len(merged[1]), 510)
+        self.assertTrue(merged[0].equals(merged[1]))
+
+    def test_bucketed_merge_types(self):
+        a = pd.DataFrame({'policy': [i % 50 for i in range(500)],
+                          'value': [float(i) for i in range(500)]})
+        b = pd.DataFrame({'policy': [float(i) for i in range(60)],
+                          'rate': [i / 100 for i in range(60)]})
+        h5a = H5('test_merge_int.h5', 'a', a, data_columns=['policy'])
+        h5b = H5('test_merge_float.h5', 'b', b, data_columns=['policy'])
+        merge = dataframe_cell.Merge()
+        merge.inputs['A'] = h5a
+        merge.inputs['B'] = h5b
+        merge.inputs['on'] = 'policy'
+        merge.inputs['buckets'] = 4
+        merge.process()
+        # integer keys are hashed as floats to find their matches
+        self.assertEqual(len(merge.outputs['dataframe'].df), 500)
+
+    def test_stop_hooks(self):
+        class Stopper(Sleepy):
+            def stop(self):
+                return super().stop()
+
+        class Inner(Stopper):
+            def stop(self):
+                return super().stop()
+        stopped = []
+        hook = on_stop(stopped.append)
+        try:
+            for cell in (Sleepy(), Stopper(), Inner()):
+                cell.stop()
+                # once per stop, however many overrides call super()
+                self.assertEqual(stopped, [cell])
+                del stopped[:]
+        finally:
+            custom_cell._stop_hooks.remove(hook)
+
+    def test_profiler(self):
+        profiler.clear()
+        h5 = H5('test_profile.h5', 'data',
+                pd.DataFrame({'a': range(100), 'b': range(100)}))
+        group = dataframe_cell.GroupBy()
+        group.py_id = 1234
+        group.inputs['dataframe'] = h5
+        group.inputs['columns'] = 'a'
+        group.process()
+        records = profiler.records(py_id=1234)
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record['cell'], 'GroupBy')
+        self.assertGreater(record['seconds'], 0)
+        for phase in ('dispatch', 'compute', 'write', 'read'):
+            self.assertIn(phase, record['phases'])
+        self.assertGreater(record['counters']['bytes_out'], 0)
+        self.assertEqual(profiler.summary()[0]['py_id'], 1234)
+
+    def test_asynchronous(self):
+        h5 = H5('test_async.h5', 'data',
+                pd.DataFrame({'a': [i % 10 for i in range(1000)],
+                              'b': range(1000)}))
+        dataframe_cell.asynchronous = True
+        try:
+            outs = []
+            for i in range(3):
+                group = dataframe_cell.GroupBy()
+                group.py_id = 2000 + i
+                group.inputs['dataframe'] = h5
+                group.inputs['columns'] = 'a'
+                group.process()
+                outs.append(group.outputs['data'])
+            # reading an output waits for its worker
+            for out in outs:
+                self.assertEqual(len(out.df), 10)
+                self.assertTrue(out.done)
+            # the worker's phases are added to the record of its cell
+            record = profiler.records(py_id=2000)[-1]
+            self.assertIn('dispatch', record['phases'])
+            self.assertIn('compute', record['phases'])
+        finally:
+            dataframe_cell.asynchronous = False
+            dataframe_cell.wait_all()
+
+    def test_timeout(self):
+        sleepy = Sleepy()
+        sleepy.py_id = 3000
+        sleepy.inputs['data'] = H5('test_timeout.h5', 'data',
+                                   pd.DataFrame({'a': range(10)}))
+        code = sleepy.process()
+        self.assertIsNone(sleepy.outputs['data'])
+        self.assertNotEqual(code, Quantum.QuReturnCode('OK').returncode)
+        self.assertTrue(sleepy.return_msg().startswith('Timed out'))
+        self.assertFalse(os.path.exists(
+            dataframe_cell.frame_path('3000.h5', 'c3000')))
+        # the failure is only reported once
+        sleepy.inputs['seconds'] = 0
+        sleepy.process()
+        self.assertEqual(len(sleepy.outputs['data'].df), 10)
+
+    def test_concurrent_crash(self):
+        for attempt in range(3):
+            workers = WorkerPool(size=8)
+            errors = []
+
+            def run(func, args):
+                try:
+                    workers.apply(func, args, timeout=10)
+                except Exception as e:
+                    errors.append(e)
+            # the workers are forked at the same time, and the crash must
+            # still be seen through the pipe of the worker that exited
+            threads = [threading.Thread(target=run, args=(time.sleep, (1,)))
+                       for i in range(7)]
+            threads.append(threading.Thread(target=run,
+                                            args=(os._exit, (1,))))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            workers.shutdown()
+            self.assertEqual(len(errors), 1)
+            # not a TimeoutError
+            self.assertIsInstance(errors[0], WorkerCrashed)
+
+    def test_send_failure(self):
+        sleepy = Sleepy()
+        sleepy.py_id = 3001
+        sleepy.inputs['data'] = H5('test_send.h5', 'data',
+                                   pd.DataFrame({'a': range(10)}))
+        # a lambda cannot be pickled to the worker
+        sleepy.inputs['seconds'] = lambda: 0
+        code = sleepy.process()
+        self.assertIsNone(sleepy.outputs['data'])
+        self.assertNotEqual(code, Quantum.QuReturnCode('OK').returncode)
+        self.assertTrue(sleepy.return_msg().startswith('Failed'))
+
+    def test_cache_manager(self):
+        from dataframe_cell import cache
+        import gc
+        a = H5('test_cache.h5', 'data', pd.DataFrame({'a': range(10)}))
+        x, y = a + 1, a + 1
+        self.assertNotEqual(x.node, y.node)
+        self.assertTrue(x.node.startswith(cache.prefix))
+        x.flush()
+        y.flush()
+        name = x.file
+        results.discard(x.file, x.node)
+        del x
+        gc.collect()
+        cache.cleanup(grace=0)
+        self.assertFalse(os.path.exists(os.path.join(plugin_cache, name)))
+        self.assertTrue(os.path.exists(os.path.join(plugin_cache, y.file)))
+
+    def test_cache_budget(self):
+        # a separate directory, so that nothing in the real cache is removed
+        path = tempfile.mkdtemp()
+        try:
+            manager = dataframe_cell.CacheManager(budget=0, path=path)
+            for name in ('kept.h5', 'old.h5'):
+                with open(os.path.join(path, name), 'wb') as f:
+                    f.write(b'0' * 100)
+            # referenced files are kept even over budget
+            manager.acquire('kept.h5')
+            self.assertEqual(manager.enforce(), 1)
+            self.assertEqual(os.listdir(path), ['kept.h5'])
+            manager.release('kept.h5')
+            self.assertEqual(manager.enforce(), 1)
+            self.assertEqual(os.listdir(path), [])
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
 
 @console_printer
 def run_test():
@@ -1,5 +1,8 @@
 import unittest
+import numpy as np
+import pandas as pd
 import projection_cell
+from dataframe_cell import H5
 import Quantum
 from Quantum import QuCell, QuCircuit
 from ctrl_console import console_printer
@@ -31,6 +34,111 @@ class Test_AstColumnCells(unittest.TestCase):
         self.col_cell.outputs['ans'] >> result
         self.assertTrue(result[-1], [2, 4, 16])
 
+    def test_astcolumn_vectorized(self):
+        self.col.inputs['f(t)'] = '(t^1) + 2*t**-1'
+        self.col.inputs['t'] = [1, 2, 4]
+        self.col.process()
+        self.assertEqual(self.col.outputs['ans'], [2.0, 4.0, 5.5])
+        self.col.inputs['f(t)'] = '__import__("os")'
+        self.assertRaises(TypeError, self.col.process)
+
+    def test_astcolumn_overflow(self):
+        f = projection_cell.AstExpression('2**t')
+        self.assertEqual(list(f(t=np.array([3, 10]))), [8, 1024])
+        # integer powers past int64 are taken in floating point
+        self.assertEqual(list(f(t=np.array([10, 70]))), [1024.0, 2.0 ** 70])
+
+    def test_numpycolumn(self):
+        col = projection_cell.NumpyColumn()
+        col.inputs['f(t)'] = 'np.exp(-0.05*t) * where(t > 1, t, 0)'
+        col.inputs['t'] = [1, 2, 3]
+        col.process()
+        self.assertEqual(col.outputs['ans'][0], 0)
+        self.assertAlmostEqual(col.outputs['ans'][2], 3 * 0.8607079764)
+        self.assertIs(projection_cell.compile_expression('t + 1'),
+                      projection_cell.compile_expression('t + 1'))
+        for expr in ('__import__("os")', 't.real', 'np.load("x")', 't[0]'):
+            col.inputs['f(t)'] = expr
+            self.assertRaises(TypeError, col.process)
+        # literal exponents that would not finish are rejected
+        for expr in ('10**10**8', '2**(10**8)', 't + 7**100000', '1 << 10**9'):
+            self.assertRaises(TypeError, projection_cell.NumpyExpression,
+                              expr)
+        f = projection_cell.NumpyExpression('t**0.5 + 2**t + 2**(1/2)')
+        self.assertAlmostEqual(f(t=4.0), 2 + 16 + 2 ** 0.5)
+
+    def test_projection(self):
+        proj = projection_cell.Projection()
+        proj.py_id = 1900
+        proj.inputs['f'] = 'l * v**t * (1 - q)'
+        proj.inputs['variables'] = {'t': np.arange(3), 'v': 1 / 1.05,
+                                    'l': [1000, 990, 975],
+                                    'q': [0.010, 0.015, 0.020]}
+        proj.process()
+        expected = np.array([990.0, 928.71428571, 866.66666667])
+        np.testing.assert_allclose(proj.outputs['ans'], expected)
+        proj.inputs['chunksize'] = 2
+        proj.process()
+        np.testing.assert_allclose(proj.outputs['ans'], expected)
+        proj.inputs['variables'] = H5('test_projection.h5', 'data',
+                                      pd.DataFrame({'t': [0, 1], 'q': 0.5}))
+        proj.inputs['f'] = 't * q'
+        proj.process()
+        self.assertEqual(list(proj.outputs['ans'].df), [0.0, 0.5])
+        proj.inputs['f'] = 't * x'
+        code = proj.process()
+        self.assertIsNone(proj.outputs['ans'])
+        self.assertNotEqual(code, Quantum.QuReturnCode('OK').returncode)
+
+    def test_recurrence(self):
+        rec = projection_cell.Recurrence()
+        rec.py_id = 2000
+        rec.inputs['initial'] = {'V': 0}
+        rec.inputs['step'] = {'V': '(V + P - E) * (1 + i) - q*S'}
+        rec.inputs['parameters'] = {'P': [100, 200], 'E': 10, 'i': 0.05,
+                                    'q': np.full((2, 2), 0.01),
+                                    'S': [1000, 2000]}
+        rec.inputs['periods'] = 2
+        rec.process()
+        expected = np.array([[0, 0], [84.5, 179.5], [173.225, 367.975]])
+        np.testing.assert_allclose(rec.outputs['ans']['V'], expected)
+        rec.inputs['shards'] = 2
+        rec.process()
+        np.testing.assert_allclose(rec.outputs['ans']['V'], expected)
+        rec.inputs['step'] = {'V': 'V + Z'}
+        rec.process()
+        self.assertIsNone(rec.outputs['ans'])
+
+    def test_tensor_outputs(self):
+        import pickle
+        rates = projection_cell.Tensor.create('test_rates.npy', (3, 4, 1))
+        rates.open('r+')[:] = 0.05
+        rec = projection_cell.Recurrence()
+        rec.py_id = 2100
+        rec.inputs['initial'] = {'V': 0}
+        rec.inputs['step'] = {'V': '(V + P) * (1 + i)'}
+        rec.inputs['parameters'] = {'P': np.ones(6), 'i': rates}
+        rec.inputs['periods'] = 3
+        rec.process()
+        expected = rec.outputs['ans']['V']
+        for shards in (1, 2):
+            rec.inputs['shards'] = shards
+            rec.inputs['tensor'] = True
+            rec.process()
+            out = rec.outputs['ans']['V']
+            self.assertIsInstance(out, projection_cell.Tensor)
+            self.assertEqual(out.shape, (4, 4, 6))
+            np.testing.assert_allclose(np.asarray(out), expected)
+        self.assertLess(len(pickle.dumps(out)), 1000)
+        proj = projection_cell.Projection()
+        proj.py_id = 2101
+        proj.inputs['f'] = 'V * 2'
+        proj.inputs['variables'] = {'V': out.view(0, 1)[:, 0, 0]}
+        proj.inputs['tensor'] = True
+        proj.process()
+        np.testing.assert_allclose(np.asarray(proj.outputs['ans']),
+                                   expected[:, 0, 0] * 2)
+
 
 @console_printer
 def run_test():
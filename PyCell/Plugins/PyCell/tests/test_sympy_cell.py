@@ -9,6 +9,8 @@ Alternatively:
 >>> exec(open('plugins/PyCell/tests/test_sympy_cell.py').read())
 """
 import unittest
+import numpy as np
+import sympy as sp
 from sympy import var, diff, integrate
 import sympy_cell
 from Quantum import *
@@ -56,6 +58,72 @@ class Test_SympyCells(unittest.TestCase):
         self.integral_cell.outputs['F(x)'] >> result
         self.assertEqual(result[-1], 4)
 
+    def test_function_cache(self):
+        x = sympy_cell.QuSym('x', values=2.0)
+        y = sympy_cell.QuSym('y', values=3.0)
+        a = sympy_cell.QuSym('a', values=2.0)
+        b = sympy_cell.QuSym('b', values=3.0)
+        f = (x * y + x ** 2) / y
+        g = (a * b + a ** 2) / b
+        self.assertIs(f.fn, g.fn)
+        self.assertIs(f.fn, ((x * y + x ** 2) / y).fn)
+        self.assertAlmostEqual(f.fn(2.0, 3.0), 10 / 3)
+
+    def test_batch_calculate(self):
+        face = sympy_cell.QuSym('S', values=np.array([1000., 2000.]))
+        rate = sympy_cell.QuSym('i', values=np.array([[0.0], [0.05]]))
+        calc = sympy_cell.Calculate()
+        calc.inputs['f(x)'] = face * (rate + 1)
+        calc.process()
+        np.testing.assert_allclose(calc.outputs['result'],
+                                   [[1000, 2000], [1050, 2100]])
+        calc.inputs['values'] = {'i': 0.1}
+        calc.process()
+        np.testing.assert_allclose(calc.outputs['result'], [1100, 2200])
+
+    def test_shared_terms(self):
+        x = sympy_cell.QuSym('x', values=2.0)
+        y = sympy_cell.QuSym('y', values=3.0)
+        self.assertIs((x * y + x).expression, (x * y + x).expression)
+        # terms inside a formula are shared, even once sympy has forgotten them
+        product = (x * y).expression
+        sp.core.cache.clear_cache()
+        f = sympy_cell.QuSym(sp.sin(x.expression * y.expression) + 1,
+                             (x.expression, y.expression), (2.0, 3.0))
+        self.assertTrue(any(term is product
+                            for term in sp.preorder_traversal(f.expression)))
+        term = (x * y + x ** 2) / y
+        calc = sympy_cell.Calculate()
+        calc.inputs['f(x)'] = {'f': term ** y, 'g': term + x}
+        calc.process()
+        self.assertAlmostEqual(calc.outputs['result']['f'], (10 / 3) ** 3)
+        self.assertAlmostEqual(calc.outputs['result']['g'], 10 / 3 + 2)
+
+    def test_bindings(self):
+        x = sympy_cell.QuSym('x', values=2.0)
+        y = sympy_cell.QuSym('y', values=3.0)
+        f = x * y + x
+        self.assertEqual(f.to_dict(),
+                         {'variables': (x.expression, y.expression),
+                          'values': (2.0, 3.0)})
+        self.assertIs((f + x).bindings, f.bindings)
+        self.assertEqual((f + sympy_cell.QuSym('x')).evaluate(), 10.0)
+        with self.assertRaises(sympy_cell.BindingConflict):
+            f + sympy_cell.QuSym('x', values=5.0)
+        g = f.subs(x * y, sympy_cell.QuSym('z', values=10.0))
+        self.assertEqual(g.evaluate(), 12.0)
+        # separate but equal arrays bind without a conflict
+        a = sympy_cell.QuSym('a', values=np.arange(3.0))
+        b = sympy_cell.QuSym('a', values=np.arange(3.0))
+        self.assertEqual(list((a + b).evaluate()), [0.0, 2.0, 4.0])
+        # missing values are the same value
+        n = sympy_cell.QuSym('n', values=np.array([1.0, np.nan]))
+        self.assertTrue(np.isnan((n + sympy_cell.QuSym(
+            'n', values=np.array([1.0, np.nan]))).evaluate()[1]))
+        m = sympy_cell.QuSym('m', values=float('nan'))
+        self.assertTrue(np.isnan((m + sympy_cell.QuSym(
+            'm', values=float('nan'))).evaluate()))
+
 
 @console_printer
 def run_test():
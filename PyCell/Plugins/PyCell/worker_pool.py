@@ -0,0 +1,334 @@
+"""
+Worker Pool
+===========
+
+Provides a pool of long-lived worker processes. Cells that must run work
+outside of the main process dispatch it to the pool instead of spawning a new
+process for every call. Workers are forked lazily, keep pandas and PyTables
+imported between tasks, and are replaced if they crash or exceed a deadline.
+
+The pool is shared by every cell. It can be tuned from the console::
+
+    >>> from PyCell.worker_pool import pool
+    >>> pool.size = 8
+    >>> pool.timeout = 60
+
+.. note::
+   Tasks are sent to workers by pickling, so the callable must be a module
+   level function and its arguments must be picklable.
+"""
+from multiprocessing import Process, Pipe
+import os
+import sys
+import threading
+import time
+import traceback
+
+
+class WorkerError(Exception):
+    """
+    Raised in the parent process when a task fails inside a worker. The
+    message holds the formatted traceback from the worker.
+    """
+    pass
+
+
+class WorkerCrashed(WorkerError):
+    """
+    Raised when a worker process dies before returning a result.
+    """
+    pass
+
+
+class Cancelled(WorkerError):
+    """
+    Raised when a task is stopped by :meth:`WorkerPool.cancel`.
+    """
+    pass
+
+
+def describe(error):
+    """
+    Returns a one line cell message for an error raised by a task, such as
+    ``'Timed out. ...'``, ``'Cancelled.'`` or ``'Failed. ...'`` with the last
+    line of the worker's traceback.
+    """
+    if isinstance(error, TimeoutError):
+        return 'Timed out. {}'.format(error)
+    if isinstance(error, Cancelled):
+        return 'Cancelled.'
+    lines = [l for l in str(error).splitlines() if l.strip()]
+    return 'Failed. {}'.format(lines[-1].strip() if lines else error)
+
+
+def _worker_loop(conn):
+    """
+    *Internal*. Main loop of a worker process. Receives ``(func, args,
+    kwargs)`` tasks from ``conn`` and replies with ``(True, result)`` or
+    ``(False, traceback)`` until it receives ``None`` or the pipe is closed.
+    """
+    try:
+        # warm the interpreter so the first task does not pay for it
+        import pandas
+        import tables
+    except ImportError:
+        pass
+
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            break
+        if task is None:
+            break
+        func, args, kwargs = task
+        try:
+            reply = (True, func(*args, **kwargs))
+        except Exception:
+            reply = (False, ''.join(traceback.format_exception(
+                                    *sys.exc_info())))
+        try:
+            conn.send(reply)
+        except Exception:
+            conn.send((False, ''.join(traceback.format_exception(
+                                      *sys.exc_info()))))
+    conn.close()
+
+
+_spawn_lock = threading.Lock()
+
+
+class _Worker(object):
+    """
+    *Internal*. A single worker process and the parent end of its pipe.
+    """
+    def __init__(self):
+        self.tag = None
+        self.cancelled = False
+        # a worker forked while another's child end is still open in the
+        # parent would hold it, and that worker's exit would never be seen
+        with _spawn_lock:
+            self.conn, child_conn = Pipe()
+            self.process = Process(target=_worker_loop, args=(child_conn,))
+            self.process.daemon = True
+            self.process.start()
+            child_conn.close()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def wait(self, timeout=None):
+        """
+        Waits up to ``timeout`` seconds for a reply. Returns ``False`` if
+        there is none in time.
+
+        :raises EOFError: If the process exits without replying, even if
+                          another process forked from the parent holds its
+                          pipe open.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            step = 1.0
+            if deadline is not None:
+                step = min(step, max(deadline - time.monotonic(), 0))
+            if self.conn.poll(step):
+                return True
+            if not self.process.is_alive():
+                if self.conn.poll(0):
+                    return True
+                raise EOFError('Worker exited without replying.')
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def terminate(self):
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(1)
+
+
+class WorkerPool(object):
+    """
+    A pool of persistent worker processes. Workers are spawned on demand up to
+    ``size`` and are reused for subsequent tasks. A worker that crashes or runs
+    past its deadline is terminated and replaced on the next request.
+
+    This class is thread-safe. Tasks submitted from several threads run
+    concurrently on separate workers.
+
+    :param size: Maximum number of worker processes. Defaults to the number of
+                 CPUs.
+    :type size: int
+    :param timeout: Default number of seconds a task may run before its worker
+                    is terminated. ``None`` waits indefinitely.
+    :type timeout: float or None
+    """
+    def __init__(self, size=None, timeout=None):
+        self.size = size or os.cpu_count() or 1
+        self.timeout = timeout
+        self.spawns = 0
+        """The number of worker processes started by this pool."""
+        self._idle = []
+        self._busy = set()
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                while self._idle:
+                    worker = self._idle.pop()
+                    if worker.is_alive():
+                        return worker
+                    worker.terminate()
+                    self._count -= 1
+                if self._count < self.size:
+                    self._count += 1
+                    break
+                self._cond.wait()
+        try:
+            worker = _Worker()
+        except:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.spawns += 1
+        return worker
+
+    def _release(self, worker, healthy):
+        with self._cond:
+            if healthy and self._count <= self.size:
+                self._idle.append(worker)
+            else:
+                self._count -= 1
+                worker.terminate()
+            self._cond.notify()
+
+    def apply(self, func, args=(), kwargs=None, timeout=None, tag=None):
+        """
+        Runs ``func(*args, **kwargs)`` on a worker and returns its result. The
+        calling thread blocks until the task finishes.
+
+        :param timeout: Seconds to wait for the result. Defaults to the pool's
+                        ``timeout``.
+        :type timeout: float or None
+        :param tag: Identifies the task to :meth:`cancel`.
+        :raises TimeoutError: If the task does not finish in time. The worker
+                              is terminated.
+        :raises Cancelled: If the task is cancelled.
+        :raises WorkerCrashed: If the worker dies while running the task.
+        :raises WorkerError: If the task raises an exception.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        worker = self._acquire()
+        worker.tag, worker.cancelled = tag, False
+        with self._cond:
+            self._busy.add(worker)
+        healthy = False
+        try:
+            worker.conn.send((func, args, kwargs or {}))
+            if not worker.wait(timeout):
+                raise TimeoutError('Task {} exceeded {} seconds.'.format(
+                                   getattr(func, '__name__', func), timeout))
+            ok, value = worker.conn.recv()
+            healthy = True
+        except TimeoutError:
+            raise
+        except (EOFError, OSError) as e:
+            if worker.cancelled:
+                raise Cancelled('Task {} was cancelled.'.format(
+                                getattr(func, '__name__', func))) from e
+            raise WorkerCrashed('Worker {} exited with code {}.'.format(
+                                worker.process.pid,
+                                worker.process.exitcode)) from e
+        finally:
+            with self._cond:
+                self._busy.discard(worker)
+            self._release(worker, healthy)
+        if not ok:
+            raise WorkerError(value)
+        return value
+
+    def map(self, func, args_list, timeout=None, tag=None):
+        """
+        Runs ``func(*args)`` for each tuple in ``args_list`` on separate
+        workers at the same time and returns the results in order. The calling
+        thread blocks until every task finishes.
+
+        :raises WorkerError: The first error raised by :meth:`apply`, once all
+                             tasks have finished.
+        """
+        args_list = list(args_list)
+        values = [None] * len(args_list)
+        errors = [None] * len(args_list)
+
+        def run(i, args):
+            try:
+                values[i] = self.apply(func, args, timeout=timeout, tag=tag)
+            except Exception as e:
+                errors[i] = e
+
+        threads = [threading.Thread(target=run, args=(i, args))
+                   for i, args in enumerate(args_list)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for error in errors:
+            if error is not None:
+                raise error
+        return values
+
+    def running(self):
+        """
+        Returns the tags of the tasks that are running.
+        """
+        with self._cond:
+            return [w.tag for w in self._busy if w.tag is not None]
+
+    def cancel(self, tag=None):
+        """
+        Terminates the workers running tasks with ``tag``, or every busy
+        worker if ``tag`` is ``None``. The callers of those tasks get
+        :class:`Cancelled`.
+
+        :returns: The number of tasks cancelled.
+        :rtype: int
+        """
+        with self._cond:
+            workers = [w for w in self._busy if tag is None or w.tag == tag]
+            for worker in workers:
+                worker.cancelled = True
+        for worker in workers:
+            # the caller sees the pipe close and replaces the worker
+            if worker.process.is_alive():
+                worker.process.terminate()
+        return len(workers)
+
+    def shutdown(self):
+        """
+        Stops all idle workers. Workers that are busy are stopped when their
+        current task finishes.
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+            self._cond.notify_all()
+        for worker in idle:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.terminate()
+
+
+pool = WorkerPool()
+"""The pool shared by all cells."""